@@ -0,0 +1,515 @@
+#! /usr/bin/python
+#
+# Offline benchmark of main.py against a local stand-in for Picasa Web Albums
+#
+# Generates a synthetic media tree, starts a fake service on localhost that
+# implements the part of the feed and upload API main.py uses, and runs
+# main.py against it in a few scenarios. Reports wall time, CPU time and
+# peak RSS of every run, so performance changes can be checked without
+# touching the real service.
+#
+# Usage:
+#   python benchmark.py [--albums N] [--files N] [--latency S] ... [-- extra main.py arguments]
+#
+
+import argparse
+import BaseHTTPServer
+import json
+import os
+import random
+import re
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+from xml.sax.saxutils import escape
+
+from PIL import Image, ImageDraw
+
+from runner import exitCode
+
+SCENARIOS = ['cold', 'resync', 'forcemetadata', 'listing']
+# Resolutions of the generated JPEGs; some are above the 2048 pixel limit, so they get resized
+JPEG_SIZES = [(640, 480), (1600, 1200), (2048, 1536), (3000, 2000), (4000, 3000)]
+PNG_SIZE = (800, 600)
+VIDEO_SIZE = 262144
+USER = 'bench@example.com'
+
+ATOM_HEADER = ("<?xml version='1.0' encoding='UTF-8'?>"
+    "<%s xmlns='http://www.w3.org/2005/Atom' xmlns:gphoto='http://schemas.google.com/photos/2007'"
+    " xmlns:openSearch='http://a9.com/-/spec/opensearchrss/1.0/'>")
+KIND = "<category scheme='http://schemas.google.com/g/2005#kind' term='http://schemas.google.com/photos/2007#%s'/>"
+
+##########################################################
+# Fake service
+##########################################################
+
+class FakePicasa(object):
+    """In-memory albums and photos, plus the fault injection settings.
+
+    latency is added to every request; throttleRate and errorRate are the
+    fractions of requests answered with 503 and 500. dropChunks is the
+    number of upcoming resumable upload chunks whose connection is closed
+    after the chunk was received, without an answer, and dropEntries the
+    number of upcoming finished resumable uploads whose entry is lost the
+    same way. dropPosts is the number of upcoming POSTs that are carried
+    out but never answered. With lateEntry, the last chunk of an upload is
+    acknowledged with a 308 and the entry is only returned when asked for.
+    script() sets the answers of the next requests to a given path.
+    """
+    def __init__(self, latency=0.0, throttleRate=0.0, errorRate=0.0, seed=0):
+        self.latency = latency
+        self.throttleRate = throttleRate
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.base = None
+        self.nextId = 1000
+        self.albums = {}
+        self.photos = {}
+        self.sessions = {}
+        self.counters = {}
+        self.dropChunks = 0
+        self.dropEntries = 0
+        self.dropPosts = 0
+        self.lateEntry = False
+        self.scripts = []
+
+    def newId(self):
+        with self.lock:
+            self.nextId += 1
+            return str(self.nextId)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def drop(self, what):
+        # True when the answer of this request is to be lost; what is 'Chunks' or 'Entries'
+        with self.lock:
+            left = getattr(self, 'drop' + what)
+            if left > 0:
+                setattr(self, 'drop' + what, left - 1)
+                self.counters['dropped' + what] = self.counters.get('dropped' + what, 0) + 1
+            return left > 0
+
+    def script(self, method, pattern, statuses):
+        # The next requests with this method and a path matching pattern are answered with
+        # these statuses in turn; None lets a request through
+        with self.lock:
+            self.scripts.append((method, re.compile(pattern), list(statuses)))
+
+    def scripted(self, method, path):
+        with self.lock:
+            for scriptMethod, pattern, statuses in self.scripts:
+                if scriptMethod == method and statuses and pattern.search(path):
+                    return statuses.pop(0)
+        return None
+
+    def fault(self):
+        # Status to answer with instead of handling the request, or None
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.throttleRate:
+            return 503
+        if draw < self.throttleRate + self.errorRate:
+            return 500
+        return None
+
+    def addAlbum(self, title):
+        albumId = self.newId()
+        self.albums[albumId] = {'title': title, 'photos': []}
+        return albumId
+
+    def addPhoto(self, albumId, title, summary, size):
+        photoId = self.newId()
+        self.photos[photoId] = {'album': albumId, 'title': title, 'summary': summary, 'size': size}
+        with self.lock:
+            self.albums[albumId]['photos'].append(photoId)
+        return photoId
+
+    def albumXml(self, albumId, root=False):
+        album = self.albums[albumId]
+        xml = (ATOM_HEADER % 'entry') if root else '<entry>'
+        xml += KIND % 'album'
+        xml += "<id>%s/data/entry/api/user/default/albumid/%s</id>" % (self.base, albumId)
+        xml += "<title type='text'>%s</title>" % escape(album['title'])
+        xml += "<link rel='http://schemas.google.com/g/2005#feed' type='application/atom+xml' href='%s/data/feed/api/user/default/albumid/%s'/>" % (self.base, albumId)
+        xml += "<link rel='edit' type='application/atom+xml' href='%s/data/entry/api/user/default/albumid/%s'/>" % (self.base, albumId)
+        xml += "<gphoto:id>%s</gphoto:id><gphoto:access>private</gphoto:access>" % albumId
+        xml += "<gphoto:numphotos>%d</gphoto:numphotos></entry>" % len(album['photos'])
+        return xml
+
+    def photoXml(self, photoId, root=False):
+        photo = self.photos[photoId]
+        xml = (ATOM_HEADER % 'entry') if root else '<entry>'
+        xml += KIND % 'photo'
+        xml += "<id>%s/data/entry/api/user/default/albumid/%s/photoid/%s</id>" % (self.base, photo['album'], photoId)
+        xml += "<title type='text'>%s</title>" % escape(photo['title'])
+        if photo['summary'] is not None:
+            xml += "<summary type='text'>%s</summary>" % escape(photo['summary'])
+        xml += "<link rel='edit' type='application/atom+xml' href='%s/data/entry/api/user/default/albumid/%s/photoid/%s'/>" % (self.base, photo['album'], photoId)
+        xml += "<link rel='edit-media' type='image/jpeg' href='%s/data/media/api/user/default/albumid/%s/photoid/%s'/>" % (self.base, photo['album'], photoId)
+        xml += "<gphoto:id>%s</gphoto:id><gphoto:albumid>%s</gphoto:albumid>" % (photoId, photo['album'])
+        xml += "<gphoto:size>%d</gphoto:size></entry>" % photo['size']
+        return xml
+
+    def feedXml(self, kind, entries, start, limit):
+        page = entries[start - 1:start - 1 + limit]
+        xml = ATOM_HEADER % 'feed'
+        xml += KIND % kind
+        xml += "<id>%s/data/feed/api/user/default</id><title>%s</title>" % (self.base, kind)
+        xml += "<openSearch:totalResults>%d</openSearch:totalResults>" % len(entries)
+        xml += "<openSearch:startIndex>%d</openSearch:startIndex>" % start
+        for entryId in page:
+            xml += self.albumXml(entryId) if kind == 'user' else self.photoXml(entryId)
+        return xml + '</feed>'
+
+def entryText(body, tag):
+    # Text of the first atom element with this tag in a posted entry, in any namespace prefix
+    match = re.search(r'<(?:\w+:)?%s[^>]*>([^<]*)</' % tag, body[:65536])
+    if match is None:
+        return None
+    return match.group(1).replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+class FakePicasaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body='', headers=None):
+        if self.lost:
+            # Done, but the client never hears about it
+            self.close_connection = 1
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/atom+xml; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self):
+        service = self.server.service
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        service.count('requests')
+        service.count('bytesReceived', len(body))
+        if service.latency > 0:
+            time.sleep(service.latency)
+        url = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(url.query)
+        self.lost = False
+        if url.path == '/accounts/ClientLogin':
+            return self.reply(200, 'SID=bench\nLSID=bench\nAuth=benchtoken\n')
+        status = service.scripted(self.command, url.path)
+        if status is None:
+            status = service.fault()
+        if status is not None:
+            service.count('injected' + str(status))
+            return self.reply(status, 'injected fault')
+        self.lost = self.command == 'POST' and service.drop('Posts')
+        handler = getattr(self, 'handle' + self.command.title())
+        return handler(service, url.path, query, body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+    def handleGet(self, service, path, query, body):
+        start = int(query.get('start-index', ['1'])[0])
+        limit = int(query.get('max-results', ['1000'])[0])
+        match = re.match(r'/data/feed/api/user/[^/]+/albumid/(\w+)$', path)
+        if match and match.group(1) in service.albums:
+            service.count('photoFeedPages')
+            return self.reply(200, service.feedXml('album', service.albums[match.group(1)]['photos'], start, limit))
+        if re.match(r'/data/feed/api/user/[^/]+$', path):
+            service.count('albumFeedPages')
+            return self.reply(200, service.feedXml('user', sorted(service.albums), start, limit))
+        match = re.match(r'/data/entry/api/user/[^/]+/albumid/\w+/photoid/(\w+)$', path)
+        if match and match.group(1) in service.photos:
+            return self.reply(200, service.photoXml(match.group(1), root=True))
+        return self.reply(404, 'not found')
+
+    def handlePost(self, service, path, query, body):
+        if re.match(r'/data/feed/api/user/[^/]+$', path):
+            service.count('albumsCreated')
+            return self.reply(201, service.albumXml(service.addAlbum(entryText(body, 'title') or 'untitled'), root=True))
+        match = re.match(r'/data/feed/api/user/[^/]+/albumid/(\w+)$', path)
+        if match and match.group(1) in service.albums:
+            service.count('uploads')
+            photoId = service.addPhoto(match.group(1), entryText(body, 'title') or 'untitled',
+                                       entryText(body, 'summary'), len(body))
+            return self.reply(201, service.photoXml(photoId, root=True))
+        match = re.match(r'/data/upload/resumable/api/user/[^/]+/albumid/(\w+)$', path)
+        if match and match.group(1) in service.albums:
+            sessionId = service.newId()
+            service.sessions[sessionId] = {'album': match.group(1), 'received': 0,
+                'title': self.headers.get('slug') or entryText(body, 'title'), 'summary': entryText(body, 'summary'),
+                'size': int(self.headers.get('x-upload-content-length') or 0)}
+            return self.reply(200, '', {'Location': '%s/upload/session/%s' % (service.base, sessionId)})
+        return self.reply(404, 'not found')
+
+    def handlePut(self, service, path, query, body):
+        match = re.match(r'/upload/session/(\w+)$', path)
+        if match and match.group(1) in service.sessions:
+            session = service.sessions[match.group(1)]
+            contentRange = self.headers.get('content-range', '')
+            query = contentRange.startswith('bytes */')
+            if not query:
+                # Bytes from the start of the chunk on; a chunk beyond what we have is ignored
+                chunk = re.match(r'bytes (\d+)-(\d+)/(\d+)$', contentRange)
+                if chunk is None or int(chunk.group(2)) - int(chunk.group(1)) + 1 != len(body):
+                    return self.reply(400, 'bad Content-Range: ' + contentRange)
+                start = int(chunk.group(1))
+                if start <= session['received']:
+                    session['received'] = max(session['received'], start + len(body))
+                if service.drop('Chunks'):
+                    self.close_connection = 1
+                    return
+            ranged = {'Range': 'bytes=0-%d' % (session['received'] - 1)} if session['received'] else {}
+            if session['received'] < session['size'] or (service.lateEntry and not query):
+                return self.reply(308, '', ranged)
+            service.count('uploads')
+            photoId = service.addPhoto(session['album'], session['title'], session['summary'], session['size'])
+            del service.sessions[match.group(1)]
+            if service.drop('Entries'):
+                self.close_connection = 1
+                return
+            return self.reply(201, service.photoXml(photoId, root=True))
+        match = re.match(r'/data/(entry|media)/api/user/[^/]+/albumid/\w+/photoid/(\w+)$', path)
+        if match and match.group(2) in service.photos:
+            photo = service.photos[match.group(2)]
+            if match.group(1) == 'entry':
+                service.count('metadataUpdates')
+                photo['title'] = entryText(body, 'title') or photo['title']
+                photo['summary'] = entryText(body, 'summary')
+                albumId = entryText(body, 'albumid')
+                if albumId in service.albums and albumId != photo['album']:
+                    # A new gphoto:albumid moves the photo
+                    service.count('moves')
+                    with service.lock:
+                        service.albums[photo['album']]['photos'].remove(match.group(2))
+                        service.albums[albumId]['photos'].append(match.group(2))
+                    photo['album'] = albumId
+            else:
+                service.count('blobUpdates')
+                photo['size'] = len(body)
+            return self.reply(200, service.photoXml(match.group(2), root=True))
+        return self.reply(404, 'not found')
+
+    def handleDelete(self, service, path, query, body):
+        match = re.match(r'/data/entry/api/user/[^/]+/albumid/\w+/photoid/(\w+)$', path)
+        if match and match.group(1) in service.photos:
+            photo = service.photos.pop(match.group(1))
+            service.albums[photo['album']]['photos'].remove(match.group(1))
+            return self.reply(200, '')
+        return self.reply(404, 'not found')
+
+class FakePicasaServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakePicasaHandler)
+        self.service = service
+        service.base = 'http://127.0.0.1:%d' % self.server_port
+
+def startServer(service):
+    server = FakePicasaServer(service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+##########################################################
+# Synthetic media
+##########################################################
+
+def makeJpeg(path, size, rnd):
+    # A gradient with a few shapes: cheap to draw, but compresses like a real picture more than a flat color
+    img = Image.new('RGB', size, (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+    draw = ImageDraw.Draw(img)
+    for i in range(12):
+        x, y = rnd.randint(0, size[0]), rnd.randint(0, size[1])
+        draw.ellipse((x, y, x + size[0] / 4, y + size[1] / 4),
+                     fill=(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+    img.save(path, 'JPEG', quality=90)
+
+def makeMediaTree(root, albums, files, pngs, videos, seed):
+    rnd = random.Random(seed)
+    for a in range(albums):
+        album = os.path.join(root, 'album%03d' % a)
+        os.makedirs(album)
+        for f in range(files):
+            makeJpeg(os.path.join(album, 'img%04d.jpg' % f), JPEG_SIZES[f % len(JPEG_SIZES)], rnd)
+        for f in range(pngs):
+            Image.new('RGB', PNG_SIZE, (rnd.randint(0, 255), 0, 0)).save(os.path.join(album, 'pic%04d.png' % f))
+        for f in range(videos):
+            with open(os.path.join(album, 'clip%04d.mp4' % f), 'wb') as out:
+                out.write(os.urandom(VIDEO_SIZE))
+
+def makeLargeAlbum(service, root, title, photos, localFiles, seed):
+    # A web album with many photos, of which only a few exist locally
+    albumId = service.addAlbum(title)
+    for p in range(photos):
+        service.addPhoto(albumId, 'web%06d.jpg' % p, None, 1024)
+    album = os.path.join(root, title)
+    os.makedirs(album)
+    rnd = random.Random(seed)
+    for f in range(localFiles):
+        makeJpeg(os.path.join(album, 'web%06d.jpg' % f), JPEG_SIZES[0], rnd)
+
+##########################################################
+# Scenarios
+##########################################################
+
+def runMain(name, service, source, workDir, extraArgs):
+    # Runs main.py in a child process; its rusage gives the CPU time and peak RSS of just that run
+    logPath = os.path.join(workDir, name + '.log')
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'),
+               '--email', USER, '--password', 'bench', '--server', service.base, '--source', source,
+               '--max-requests-per-second', '0'] + extraArgs
+    # A home of its own, so the runs leave ~/.picasawebuploader alone
+    env = dict(os.environ)
+    env['HOME'] = workDir
+    before = dict(service.counters)
+    started = time.time()
+    with open(logPath, 'w') as log:
+        child = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+        pid, status, usage = os.wait4(child.pid, 0)
+        status = child.returncode = exitCode(status)
+    wall = time.time() - started
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    counters = dict((k, v - before.get(k, 0)) for k, v in service.counters.items() if v != before.get(k, 0))
+    result = {'scenario': name, 'wall': wall, 'cpu': usage.ru_utime + usage.ru_stime,
+              'peakRss': rss, 'exitStatus': status, 'server': counters, 'log': logPath}
+    if status != 0:
+        print "*** " + name + " failed, see " + logPath
+    return result
+
+def runScenarios(args, extraArgs):
+    workDir = tempfile.mkdtemp('picasabench')
+    try:
+        source = os.path.join(workDir, 'media')
+        os.makedirs(source)
+        print "*** generating media in " + source
+        makeMediaTree(source, args.albums, args.files, args.pngs, args.videos, args.seed)
+        manifest = ['--manifest', os.path.join(workDir, 'manifest.sqlite')]
+
+        service = FakePicasa(args.latency, args.throttle_rate, args.error_rate, args.seed)
+        server = startServer(service)
+        results = []
+        for name in args.scenario or SCENARIOS:
+            print "*** running " + name
+            if name == 'cold':
+                # Empty account and manifest: everything is uploaded
+                service.albums.clear()
+                service.photos.clear()
+                if os.path.exists(manifest[1]):
+                    os.remove(manifest[1])
+                results.append(runMain(name, service, source, workDir, manifest + extraArgs))
+            elif name == 'resync':
+                # Nothing changed since the last run
+                results.append(runMain(name, service, source, workDir, manifest + extraArgs))
+            elif name == 'forcemetadata':
+                results.append(runMain(name, service, source, workDir, manifest + ['--forcemetadata'] + extraArgs))
+            elif name == 'listing':
+                # A separate account with one large album, listed without the help of a manifest
+                listingService = FakePicasa(args.latency, args.throttle_rate, args.error_rate, args.seed)
+                listingServer = startServer(listingService)
+                listingSource = os.path.join(workDir, 'listing')
+                makeLargeAlbum(listingService, listingSource, 'large', args.large_album, args.files, args.seed)
+                results.append(runMain(name, listingService, listingSource, workDir, ['--no-manifest'] + extraArgs))
+                listingServer.shutdown()
+        server.shutdown()
+        return results
+    finally:
+        if args.keep:
+            print "*** work directory kept: " + workDir
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+##########################################################
+# Memory of the local media index
+##########################################################
+
+def deepSize(obj, seen):
+    # Bytes held by obj and everything it references, each object counted once
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deepSize(k, seen) + deepSize(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deepSize(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deepSize(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    elif hasattr(obj, '__dict__'):
+        size += deepSize(obj.__dict__, seen)
+    return size
+
+def measureIndex(files, perDir):
+    # Memory of the local tree held by main.py for a synthetic library of the given size: the
+    # MediaIndex of LocalAlbums, against the dicts of {'files': [...], 'path': ...} used before
+    import main
+    index = main.MediaIndex()
+    dicts = {}
+    for d in range((files + perDir - 1) // perDir):
+        path = '/volume1/photo/%d/%d-%02d event %05d' % (2000 + d % 20, 2000 + d % 20, 1 + d % 12, d)
+        # Fresh strings for every directory, like os.listdir() returns
+        names = ['IMG_%04d.JPG' % i for i in range(min(perDir, files - d * perDir))]
+        index.add(main.LocalAlbum(path, [(name, 2500000 + i, 1400000000.0 + i) for i, name in enumerate(names)]))
+        dicts[os.path.basename(path)] = {'files': names, 'path': path}
+    return {'files': files, 'dictBytes': deepSize(dicts, set()), 'indexBytes': deepSize(index, set())}
+
+def printResults(results):
+    print ''
+    print '%-14s %10s %10s %12s  %s' % ('scenario', 'wall (s)', 'cpu (s)', 'peak RSS MB', 'server')
+    for r in results:
+        server = ', '.join('%s=%d' % item for item in sorted(r['server'].items()))
+        print '%-14s %10.2f %10.2f %12.1f  %s' % (r['scenario'], r['wall'], r['cpu'], r['peakRss'] / 1048576.0, server)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark main.py against a local fake of the Picasa Web Albums service; '
+                                     'arguments after "--" are passed on to main.py')
+    parser.add_argument('--scenario', help='scenario to run, may be repeated (default: all, in this order: ' + ', '.join(SCENARIOS) + ')',
+                        choices=SCENARIOS, action='append')
+    parser.add_argument('--albums', help='number of generated albums (default: 4)', type=int, default=4)
+    parser.add_argument('--files', help='JPEGs per album (default: 25)', type=int, default=25)
+    parser.add_argument('--pngs', help='PNGs per album (default: 2)', type=int, default=2)
+    parser.add_argument('--videos', help='dummy videos per album (default: 1)', type=int, default=1)
+    parser.add_argument('--large-album', help='photos in the web album of the listing scenario (default: 5000)', type=int, default=5000)
+    parser.add_argument('--latency', help='seconds added to every request (default: 0)', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', help='fraction of requests answered with 503 (default: 0)', type=float, default=0.0)
+    parser.add_argument('--error-rate', help='fraction of requests answered with 500 (default: 0)', type=float, default=0.0)
+    parser.add_argument('--seed', help='seed for the generated media and the injected faults (default: 0)', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this JSON file', required=False)
+    parser.add_argument('--keep', help='keep the generated media, manifest and logs', action='store_true')
+    parser.add_argument('--index-files', help='instead of running main.py, measure the memory of the local media index for this many files', type=int, required=False)
+    parser.add_argument('--index-dir-files', help='files per directory with --index-files (default: 200)', type=int, default=200)
+
+    argv = sys.argv[1:]
+    extraArgs = []
+    if '--' in argv:
+        extraArgs = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    if args.index_files:
+        m = measureIndex(args.index_files, args.index_dir_files)
+        for name, key in [('dicts', 'dictBytes'), ('MediaIndex', 'indexBytes')]:
+            print '%-12s %10.1f MB %8.1f bytes/file' % (name, m[key] / 1048576.0, float(m[key]) / m['files'])
+        sys.exit(0)
+
+    results = runScenarios(args, extraArgs)
+    printResults(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
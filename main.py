@@ -17,8 +17,9 @@
 #    under 15 mins are free for storage; see: https://support.google.com/picasa/answer/6558?hl=en
 #  - Maximum picture size is 50 MB, maximum video size is 1 GB; 
 #    see: https://support.google.com/picasa/answer/43879
-#    => However, when trying to upload a video larger than 100 MB, the call gets suspended immediately
-#       with a "broken pipe" error. Therefore, we cap on 100 MB.
+#    => However, when trying to upload a video larger than 100 MB in a single POST, the call gets
+#       suspended immediately with a "broken pipe" error. Videos and large pictures are therefore
+#       sent in chunks through the resumable upload protocol, which is capped on 1 GB.
 #
 
 import sys
@@ -29,43 +30,135 @@ if sys.version_info < (2,7):
     sys.exit(1)
 
 import argparse
-#import atom
-#import atom.service
-import filecmp
-import gdata
-import gdata.photos.service
-import gdata.media
-import gdata.geo
+import array
+import atexit
+import collections
+import cStringIO
 import getpass
+import hashlib
+import httplib
+import json
+import math
+import multiprocessing
 import os
+import random
+import shutil
 import tempfile
+import threading
 import time
 import subprocess
 import re
-import PIL
-
-from gdata.photos.service import atom, GPHOTOS_INVALID_ARGUMENT, GPHOTOS_INVALID_CONTENT_TYPE, GooglePhotosException
+import socket
+import urlparse
+import Queue
+import sqlite3
+import struct
 
 PICASA_MAX_FREE_IMAGE_DIMENSION = 2048
-PICASA_MAX_VIDEO_SIZE_BYTES = 104857600
+PICASA_MAX_VIDEO_SIZE_BYTES = 1073741824
+PICASA_SERVER = 'https://picasaweb.google.com'
+# Files above this size are uploaded in chunks; chunks must be multiples of 256 KB
+RESUMABLE_UPLOAD_THRESHOLD = 10485760
+RESUMABLE_CHUNK_SIZE = 8388608
+RESUMABLE_MAX_RESUMES = 5
+RETRY_MAX_ATTEMPTS = 8
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 300
+# Consecutive throttling responses after which all workers pause, and for how long
+CIRCUIT_BREAKER_THRESHOLD = 3
+CIRCUIT_BREAKER_COOLDOWN = 120
+# Client side request budget; 0 means no limit
+RATE_LIMIT_REQUESTS_PER_SECOND = 0
+RATE_LIMIT_BYTES_PER_SECOND = 0
+# Seconds between two looks at the --budget-file, and between two reports of the bandwidth used
+BUDGET_CHECK_INTERVAL = 1
+# Idle keep-alive connections kept per host, and how long an idle one is trusted
+CONNECTION_POOL_SIZE = 16
+CONNECTION_IDLE_TIMEOUT = 60
+FEED_PAGE_SIZE = 1000
+SCAN_THREADS = 8
+HASH_BLOCK_SIZE = 1048576
+PARTIAL_HASH_SIZE = 65536
+# Watch mode: seconds a file must stay unchanged before it is uploaded, and rescan interval without inotify
+WATCH_SETTLE_SECONDS = 5
+WATCH_POLL_INTERVAL = 60
+EXIFTOOL_BATCH_SIZE = 100
+# Media descriptors kept for files being worked on; a file is probed again once it dropped out
+MEDIA_CACHE_SIZE = 4096
+# Resampling filters for --resize-filter, by name of the PIL constant
+RESIZE_FILTERS = ['NEAREST', 'BILINEAR', 'BICUBIC', 'ANTIALIAS']
+# Resized images are kept in memory up to this size, and spooled to disk above it
+SPOOL_THRESHOLD = 8388608
+# Environment variable the password may be passed in, e.g. by runner.py
+PASSWORD_ENVIRONMENT = 'PICASA_PASSWORD'
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.expanduser('~'), '.picasawebuploader', 'manifest.sqlite')
+# Where tools were found on the PATH, and for how long that is trusted (seconds)
+TOOL_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.picasawebuploader', 'tools.json')
+TOOL_CACHE_MAX_AGE = 86400
 
 # global variables
 skipdirs = None
-
+picasaServer = PICASA_SERVER
+uploadPool = None
+metadataPool = None
+manifest = None
+albumIndex = None
+vanishedFiles = None
+resizePool = None
+resizeWorkers = 0
+resizeQuality = 99
+resizeFilter = 'ANTIALIAS'
+spoolDir = None
+spoolThreshold = SPOOL_THRESHOLD
+
+
+# gdata, PIL, PYEXIV2, EXIFTOOL and SIPS are only looked for when first needed, which keeps
+# the start of runs with nothing to do short. The HAS_ flags are None until then.
+HAS_PIL_IMAGE = None
+HAS_PYEXIV2 = None
+HAS_EXIF = None
+HAS_SIPS = None
+exifTool = None
+sipsTool = None
+toolLock = threading.Lock()
+# Module of the gdata library, imported by loadGdata()
+gdata = None
 
 # Try to import PIL if installed
+def hasPIL():
+    global HAS_PIL_IMAGE, Image
+    if HAS_PIL_IMAGE is None:
+        try:
+            from PIL import Image
+            HAS_PIL_IMAGE = True
+        except:
+            HAS_PIL_IMAGE = False
+    return HAS_PIL_IMAGE
+
+# Try to import SCANDIR (os.scandir for Python 2) if installed
 try:
-    from PIL import Image
-    HAS_PIL_IMAGE = True
+    from scandir import scandir
+    HAS_SCANDIR = True
 except:
-    HAS_PIL_IMAGE = False
+    HAS_SCANDIR = False
 
-# Try to import PY_EXIV2 if installed
+# Try to import PYINOTIFY (Linux file system events) if installed
 try:
-    import pyexiv2
-    HAS_PYEXIV2 = True
+    import pyinotify
+    HAS_PYINOTIFY = True
 except:
-    HAS_PYEXIV2 = False
+    HAS_PYINOTIFY = False
+
+# Try to import PY_EXIV2 if installed
+def hasPyexiv2():
+    global HAS_PYEXIV2, pyexiv2
+    if HAS_PYEXIV2 is None:
+        try:
+            import pyexiv2
+            HAS_PYEXIV2 = True
+        except:
+            HAS_PYEXIV2 = False
+    return HAS_PYEXIV2
 
 
 # Finds an executable on linux or windows PATH with a specific name
@@ -91,28 +184,53 @@ def which(program):
     
     return None
 
-# Try to find EXIFTOOL if installed
-exifTool = which('exiftool')
-if (exifTool is not None):
-    print '*** exiftool found at: ' + exifTool
-    HAS_EXIF = True
-else:
-    HAS_EXIF = False
+def readToolCache():
+    try:
+        with open(TOOL_CACHE_PATH) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def writeToolCache(cache):
+    try:
+        dir = os.path.dirname(TOOL_CACHE_PATH)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        tmpPath = TOOL_CACHE_PATH + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmpPath, TOOL_CACHE_PATH)
+    except (IOError, OSError):
+        pass
+
+def findTool(program):
+    # which(), remembered between runs in the tool cache. Entries are only used for the same
+    # PATH, for TOOL_CACHE_MAX_AGE seconds, and while the tool found is still there.
+    cache = readToolCache()
+    key = program + os.pathsep + os.environ.get('PATH', '')
+    cached = cache.get(key)
+    if cached is not None and 0 <= time.time() - cached[1] < TOOL_CACHE_MAX_AGE:
+        if cached[0] is None or os.access(cached[0], os.X_OK):
+            return cached[0]
+    path = which(program)
+    cache[key] = [path, time.time()]
+    writeToolCache(cache)
+    return path
 
 # Try to find SIPS if installed
-sipsTool = which('sips')
-if (sipsTool is not None):
-    print '*** sips found at: ' + sipsTool
-    HAS_SIPS = True
-else:
-    HAS_SIPS = False
-    
-    
-    
-class VideoEntry(gdata.photos.PhotoEntry):
-    pass
+def hasSips():
+    global HAS_SIPS, sipsTool
+    with toolLock:
+        if HAS_SIPS is None:
+            sipsTool = findTool('sips')
+            HAS_SIPS = sipsTool is not None
+            if HAS_SIPS:
+                print '*** sips found at: ' + sipsTool
+    return HAS_SIPS
 
-gdata.photos.VideoEntry = VideoEntry
+##########################################################
+# gdata, loaded on first login
+##########################################################
 
 def InsertVideo(self, album_or_uri, video, filename_or_handle, content_type='image/jpeg'):
     """Copy of InsertPhoto which removes protections since it *should* work"""
@@ -135,16 +253,17 @@ def InsertVideo(self, album_or_uri, video, filename_or_handle, content_type='ima
         os.path.exists(filename_or_handle): # it's a file name
         mediasource = gdata.MediaSource()
         mediasource.setFile(filename_or_handle, content_type)
-    elif hasattr(filename_or_handle, 'read'):# it's a file-like resource
-        if hasattr(filename_or_handle, 'seek'):
-            filename_or_handle.seek(0) # rewind pointer to the start of the file
-        # gdata.MediaSource needs the content length, so read the whole image
-        file_handle = StringIO.StringIO(filename_or_handle.read())
+    elif hasattr(filename_or_handle, 'read') and hasattr(filename_or_handle, 'seek'):# it's a file-like resource
+        # gdata.MediaSource needs the content length; take it from the end
+        # of the file instead of reading the whole video into memory
+        filename_or_handle.seek(0, 2)
+        content_length = filename_or_handle.tell()
+        filename_or_handle.seek(0) # rewind pointer to the start of the file
         name = 'image'
         if hasattr(filename_or_handle, 'name'):
             name = filename_or_handle.name
-        mediasource = gdata.MediaSource(file_handle, content_type,
-            content_length=file_handle.len, file_name=name)
+        mediasource = gdata.MediaSource(filename_or_handle, content_type,
+            content_length=content_length, file_name=name)
     else: #filename_or_handle is not valid
         raise GooglePhotosException({'status':GPHOTOS_INVALID_ARGUMENT,
             'body':'`filename_or_handle` must be a path name or a file-like object',
@@ -163,19 +282,982 @@ def InsertVideo(self, album_or_uri, video, filename_or_handle, content_type='ima
     except gdata.service.RequestError, e:
         raise GooglePhotosException(e.args[0])
 
-gdata.photos.service.PhotosService.InsertVideo = InsertVideo
+##########################################################
+# Resumable (chunked) uploads
+##########################################################
+
+class ResumableUpload(object):
+    """Upload of one file in fixed-size chunks with the resumable upload protocol.
+
+    The entry metadata is POSTed to the resumable upload URL of the album,
+    which answers with a session location. The file is then PUT to that
+    location one chunk at a time, each with a Content-Range header; the
+    server acknowledges every chunk with "308 Resume Incomplete" and the
+    received range, and the last one with the created entry. When a
+    connection drops, the server is asked how much it got and the upload
+    continues from there. Only one chunk is held in memory.
+
+    Calling run() again after it raised continues the same session. A
+    session of an earlier run can be continued by passing its location;
+    onSession is called with the location of every new session, so it can
+    be written down for that. The file is hashed as its chunks go out, see
+    digest().
+
+    A session the server no longer knows may have expired, or may have been
+    finished without the answer reaching us. Before a new session is
+    started in its place, findEntry is asked for the entry of the file in
+    the web album, and that entry is returned when there is one.
+    """
+    def __init__(self, gd_client, album, entry, path, contentType, server=None, location=None, onSession=None,
+                 findEntry=None):
+        self.gd_client = gd_client
+        self.album = album
+        self.entry = entry
+        self.path = path
+        self.contentType = contentType
+        self.server = server or picasaServer
+        self.size = os.path.getsize(path)
+        self.location = location
+        self.onSession = onSession
+        self.findEntry = findEntry
+        self.expired = False
+        self.offset = 0
+        # Hash of the bytes sent so far, in order from the start of the file
+        self.hasher = hashlib.sha1()
+        self.hashed = 0
+
+    def headers(self, extra):
+        headers = {'Authorization': 'GoogleLogin auth=' + self.gd_client.GetClientLoginToken(),
+                   'GData-Version': '2'}
+        headers.update(extra)
+        return headers
+
+    def request(self, method, url, body, headers):
+        # Sent over the client's own transport, so chunks reuse its kept-alive connections
+        headers = self.headers(headers)
+        headers['Content-Length'] = str(len(body))
+        rateLimiter.acquire(len(body))
+        status = None
+        try:
+            response = self.gd_client.http_client.request(method, url, body, headers)
+            status = response.status
+            return response, response.read()
+        finally:
+            rateLimiter.release(status)
+
+    def fail(self, response, body):
+        raise GooglePhotosException({'status': response.status, 'body': body, 'reason': response.reason})
+
+    def start(self):
+        url = '%s/data/upload/resumable/api/user/default/albumid/%s' % (self.server, self.album.gphoto_id.text)
+        response, body = self.request('POST', url, self.entry.ToString(), {
+            'Content-Type': 'application/atom+xml',
+            'Slug': os.path.basename(self.path),
+            'X-Upload-Content-Type': self.contentType,
+            'X-Upload-Content-Length': str(self.size)})
+        if response.status not in (200, 201):
+            self.fail(response, body)
+        self.location = response.getheader('location')
+        self.expired = False
+        self.offset = 0
+        if self.onSession is not None:
+            self.onSession(self.location)
+
+    def acknowledged(self, response):
+        # "Range: bytes=0-N" tells how much the server has; no header means nothing yet
+        received = response.getheader('range')
+        if received is None:
+            return 0
+        return int(received.rsplit('-', 1)[1]) + 1
+
+    def queryOffset(self):
+        response, body = self.request('PUT', self.location, '', {
+            'Content-Range': 'bytes */%d' % self.size})
+        if response.status == 308:
+            return None, self.acknowledged(response)
+        if response.status in (200, 201):
+            return body, self.size
+        if response.status in (404, 410):
+            # The session is gone; the next attempt looks for the entry, then starts a new one
+            self.location = None
+            self.expired = True
+        self.fail(response, body)
+
+    def restart(self):
+        # Entry of a session that turns out to have finished after all, else None and a new session
+        if self.expired and self.findEntry is not None:
+            entry = self.findEntry()
+            if entry is not None:
+                log("-> upload session expired, but the file is in the web album already")
+                return entry
+        self.start()
+        return None
+
+    def run(self):
+        if self.location is None:
+            entry = self.restart()
+            if entry is not None:
+                return entry
+        elif self.offset < self.size:
+            # Resuming after an error: ask the server where it stands
+            try:
+                body, self.offset = self.queryOffset()
+            except GooglePhotosException:
+                if self.location is not None:
+                    raise
+                # The session is gone meanwhile; start over unless it was finished
+                entry = self.restart()
+                if entry is not None:
+                    return entry
+                body = None
+            if body is not None:
+                return gdata.photos.PhotoEntryFromString(body)
+        resumes = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                if self.offset >= self.size:
+                    # Nothing left to send (or an empty file): the server owes us the entry
+                    body, self.offset = self.queryOffset()
+                    if body is not None:
+                        return gdata.photos.PhotoEntryFromString(body)
+                    if self.offset >= self.size:
+                        raise GooglePhotosException({'status': 308, 'body': '',
+                            'reason': 'all %d bytes acknowledged but no entry returned' % self.size})
+                    continue
+                f.seek(self.offset)
+                chunk = f.read(RESUMABLE_CHUNK_SIZE)
+                end = self.offset + len(chunk) - 1
+                if self.offset == self.hashed:
+                    self.hasher.update(chunk)
+                    self.hashed += len(chunk)
+                try:
+                    response, body = self.request('PUT', self.location, chunk, {
+                        'Content-Type': self.contentType,
+                        'Content-Range': 'bytes %d-%d/%d' % (self.offset, end, self.size)})
+                except (socket.error, httplib.HTTPException), e:
+                    resumes += 1
+                    if resumes > RESUMABLE_MAX_RESUMES:
+                        raise GooglePhotosException({'status': 0, 'body': str(e), 'reason': 'connection lost'})
+                    log("-> connection lost at byte " + str(self.offset) + ", resuming")
+                    body, self.offset = self.queryOffset()
+                    if body is not None:
+                        return gdata.photos.PhotoEntryFromString(body)
+                    continue
+                if response.status in (200, 201):
+                    self.offset = self.size
+                    return gdata.photos.PhotoEntryFromString(body)
+                if response.status != 308:
+                    self.fail(response, body)
+                self.offset = self.acknowledged(response)
+
+    def digest(self):
+        # fileHash() of the file, or None when part of it was sent by an earlier run
+        if self.hashed < self.size:
+            return None
+        return self.hasher.hexdigest()
+
+##########################################################
+# Concurrent upload pipeline
+##########################################################
+
+# Per-thread state: upload workers collect their log lines here
+threadState = threading.local()
+printLock = threading.Lock()
+
+def log(message):
+    # Output produced by a worker is buffered per file and printed in one piece,
+    # so the log of a parallel run reads the same as a sequential one
+    lines = getattr(threadState, 'log', None)
+    if lines is not None:
+        lines.append(message)
+    elif uploadPool is not None and uploadPool.workers:
+        # A line of the main thread waits for the output of the files queued before it
+        uploadPool.note(message)
+    else:
+        with printLock:
+            print message
+
+class UploadPool(object):
+    """Bounded pool of upload workers, each with its own gdata client.
+
+    Files are processed in parallel, but the log output of each file is
+    printed in submission order, which keeps per-album ordering deterministic.
+    Lines logged by the submitting thread take their place in that order.
+    task names what the pool does to a file, for the count of failures. A
+    lazy pool logs its clients in when the first file is submitted, for
+    work that may well not be needed.
+    """
+    def __init__(self, jobs, clientFactory, task='upload', lazy=False):
+        self.jobs = jobs
+        self.clientFactory = clientFactory
+        self.task = task
+        self.tasks = Queue.Queue(maxsize=jobs * 2)
+        self.lock = threading.Lock()
+        self.nextSubmit = 0
+        self.nextPrint = 0
+        self.finished = {}
+        self.failures = 0
+        self.workers = []
+        if not lazy:
+            # Log in for every worker up front, so authentication errors show up immediately
+            self.start()
+
+    def start(self):
+        for gd_client in [self.clientFactory() for i in range(self.jobs)]:
+            worker = threading.Thread(target=self.work, args=(gd_client,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, func, *args):
+        # Blocks while the queue is full, so discovery never runs far ahead of the uploads
+        if not self.workers:
+            self.start()
+        with self.lock:
+            seq = self.nextSubmit
+            self.nextSubmit += 1
+        self.tasks.put((seq, func, args))
+
+    def note(self, message):
+        # Printed in submission order too, as if it were the output of a file
+        with self.lock:
+            seq = self.nextSubmit
+            self.nextSubmit += 1
+        self.flush(seq, [message])
+
+    def work(self, gd_client):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            seq, func, args = task
+            threadState.log = []
+            try:
+                func(gd_client, *args)
+            except Exception, e:
+                threadState.log.append("-> failed: " + str(e))
+                with self.lock:
+                    self.failures += 1
+            lines = threadState.log
+            threadState.log = None
+            self.flush(seq, lines)
+
+    def flush(self, seq, lines):
+        with self.lock:
+            self.finished[seq] = lines
+            while self.nextPrint in self.finished:
+                with printLock:
+                    for line in self.finished.pop(self.nextPrint):
+                        print line
+                self.nextPrint += 1
+
+    def join(self):
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.failures > 0:
+            print "*** " + str(self.failures) + " file(s) failed to " + self.task
+
+##########################################################
+# Run statistics
+##########################################################
+
+# Quantiles reported per stage
+REPORT_QUANTILES = [0.5, 0.95, 0.99]
+REPORT_FORMATS = ['json', 'prometheus']
+
+def percentile(samples, fraction):
+    # Nearest-rank percentile of a sorted list
+    if not samples:
+        return 0.0
+    rank = int(math.ceil(fraction * len(samples))) - 1
+    return samples[max(0, min(rank, len(samples) - 1))]
+
+class StageTimer(object):
+    """Times one pass through a stage; a failing pass is counted as an error of the stage."""
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.stats.record(self.stage, time.time() - self.started, self.bytesIn, self.bytesOut)
+        else:
+            self.stats.count(self.stage + '_errors')
+        return False
+
+class RunStats(object):
+    """Per-stage latencies and byte counts, plus event counters, of one run.
+
+    Stages: scan (listing a local directory), listing (a page of a web feed),
+    probe (reading a file header), resize, metadata (reading local metadata),
+    upload and metadata-put. Every file passing a stage adds one latency
+    sample; the report gives p50/p95/p99 of them.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.bytesIn = {}
+        self.bytesOut = {}
+        self.counters = {}
+
+    def timed(self, stage):
+        return StageTimer(self, stage)
+
+    def record(self, stage, seconds, bytesIn=0, bytesOut=0):
+        with self.lock:
+            self.latencies.setdefault(stage, []).append(seconds)
+            self.bytesIn[stage] = self.bytesIn.get(stage, 0) + bytesIn
+            self.bytesOut[stage] = self.bytesOut.get(stage, 0) + bytesOut
+
+    def count(self, event, n=1):
+        with self.lock:
+            self.counters[event] = self.counters.get(event, 0) + n
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            files = len(self.latencies.get('upload', []))
+            uploaded = self.bytesOut.get('upload', 0)
+            stages = {}
+            for stage, samples in self.latencies.items():
+                samples = sorted(samples)
+                stage_summary = {'count': len(samples), 'seconds': sum(samples), 'max': samples[-1],
+                                 'bytesIn': self.bytesIn[stage], 'bytesOut': self.bytesOut[stage]}
+                for q in REPORT_QUANTILES:
+                    stage_summary['p' + str(int(q * 100))] = percentile(samples, q)
+                stages[stage] = stage_summary
+            return {'elapsed': elapsed, 'files': files, 'bytes': uploaded,
+                    'filesPerSecond': files / elapsed if elapsed > 0 else 0.0,
+                    'megabytesPerSecond': uploaded / 1048576.0 / elapsed if elapsed > 0 else 0.0,
+                    'counters': dict(self.counters), 'stages': stages}
+
+    def prometheus(self):
+        # Text exposition format, for the textfile collector of node_exporter
+        summary = self.summary()
+        prefix = 'picasawebuploader_'
+        lines = ['# TYPE ' + prefix + 'stage_seconds summary']
+        for stage in sorted(summary['stages']):
+            s = summary['stages'][stage]
+            for q in REPORT_QUANTILES:
+                lines.append('%sstage_seconds{stage="%s",quantile="%s"} %f' % (prefix, stage, q, s['p' + str(int(q * 100))]))
+            lines.append('%sstage_seconds_sum{stage="%s"} %f' % (prefix, stage, s['seconds']))
+            lines.append('%sstage_seconds_count{stage="%s"} %d' % (prefix, stage, s['count']))
+        lines.append('# TYPE ' + prefix + 'stage_bytes_in_total counter')
+        for stage in sorted(summary['stages']):
+            lines.append('%sstage_bytes_in_total{stage="%s"} %d' % (prefix, stage, summary['stages'][stage]['bytesIn']))
+        lines.append('# TYPE ' + prefix + 'stage_bytes_out_total counter')
+        for stage in sorted(summary['stages']):
+            lines.append('%sstage_bytes_out_total{stage="%s"} %d' % (prefix, stage, summary['stages'][stage]['bytesOut']))
+        lines.append('# TYPE ' + prefix + 'events_total counter')
+        for event in sorted(summary['counters']):
+            lines.append('%sevents_total{event="%s"} %d' % (prefix, event, summary['counters'][event]))
+        lines.append('# TYPE ' + prefix + 'run_seconds gauge')
+        lines.append('%srun_seconds %f' % (prefix, summary['elapsed']))
+        lines.append('# TYPE ' + prefix + 'files_per_second gauge')
+        lines.append('%sfiles_per_second %f' % (prefix, summary['filesPerSecond']))
+        lines.append('# TYPE ' + prefix + 'megabytes_per_second gauge')
+        lines.append('%smegabytes_per_second %f' % (prefix, summary['megabytesPerSecond']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format):
+        # Written next to the target and renamed, so a collector never reads half a report
+        if format == 'prometheus':
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.summary(), indent=1, sort_keys=True) + '\n'
+        tempPath = path + '.tmp'
+        with open(tempPath, 'w') as f:
+            f.write(text)
+        os.rename(tempPath, path)
+
+stats = RunStats()
+
+##########################################################
+# Retries, circuit breaker and dead letters
+##########################################################
+
+class OutcomeUnknown(Exception):
+    """A POST went unanswered and looking for what it creates failed too.
+
+    It may have been carried out, so it is not sent again in this run; the
+    next run sees on the web whether it arrived.
+    """
+
+# Errors a gdata call may fail with; loadGdata() adds the ones of gdata
+RETRY_EXCEPTIONS = (OutcomeUnknown, socket.error, httplib.HTTPException)
+# The service asks us to slow down
+THROTTLE_STATUSES = set([429, 503])
+# Server side trouble that may go away
+TRANSIENT_STATUSES = set([0, 500, 502, 504])
+
+def errorStatus(e):
+    # HTTP status (or gphoto error code) of a failed call; 0 when the connection failed
+    if isinstance(e, (socket.error, httplib.HTTPException)):
+        return 0, str(e)
+    if isinstance(e, GooglePhotosException):
+        return e.error_code, e.body
+    if isinstance(e, gdata.service.RequestError) and e.args and isinstance(e.args[0], dict):
+        return e.args[0].get('status'), e.args[0].get('body', '')
+    return 0, str(e)
+
+class CircuitBreaker(object):
+    """Run-wide pause of all gdata calls while the service is throttling us.
+
+    After CIRCUIT_BREAKER_THRESHOLD throttling responses in a row, every
+    caller waits until the cooldown is over instead of each worker backing
+    off on its own.
+    """
+    def __init__(self, threshold=CIRCUIT_BREAKER_THRESHOLD, cooldown=CIRCUIT_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.throttles = 0
+        self.openUntil = 0
+
+    def wait(self):
+        with self.lock:
+            remaining = self.openUntil - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def succeeded(self):
+        with self.lock:
+            self.throttles = 0
+
+    def throttled(self):
+        with self.lock:
+            self.throttles += 1
+            if self.throttles >= self.threshold and self.openUntil < time.time():
+                self.openUntil = time.time() + self.cooldown
+                log("*** service is throttling, pausing uploads for " + str(self.cooldown) + " seconds")
+
+class RetryPolicy(object):
+    """Bounded, jittered exponential backoff around a gdata call."""
+    def __init__(self, maxAttempts=RETRY_MAX_ATTEMPTS, baseDelay=RETRY_BASE_DELAY, maxDelay=RETRY_MAX_DELAY, breaker=None):
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.breaker = breaker or CircuitBreaker()
+
+    def classify(self, e):
+        if isinstance(e, OutcomeUnknown):
+            return 'fatal'
+        status, body = errorStatus(e)
+        if 'REJECTED_USER_LIMIT' in str(body):
+            # The upload quota is used up; retrying will not help before it is reset
+            return 'fatal'
+        if status in THROTTLE_STATUSES:
+            return 'throttle'
+        if status in TRANSIENT_STATUSES:
+            return 'retry'
+        return 'fatal'
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.breaker.wait()
+            try:
+                result = func(*args, **kwargs)
+                self.breaker.succeeded()
+                return result
+            except RETRY_EXCEPTIONS, e:
+                kind = self.classify(e)
+                attempt += 1
+                if kind == 'fatal' or attempt >= self.maxAttempts:
+                    raise
+                stats.count('retries')
+                if kind == 'throttle':
+                    stats.count('throttled')
+                    self.breaker.throttled()
+                # Jitter keeps parallel workers from retrying in lockstep
+                delay = min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1))
+                delay = random.uniform(delay / 2.0, delay)
+                log("Got exception " + str(e))
+                log("retrying in " + str(int(delay)) + " seconds")
+                time.sleep(delay)
+
+retryPolicy = RetryPolicy()
+
+def recoverPost(e, description, find):
+    # A POST that failed without an answer (status 0) may have been carried out all the same:
+    # find() looks for what it creates before the caller's retry sends it again
+    if errorStatus(e)[0] != 0:
+        raise e
+    log("-> no answer, looking for " + description + " on the web")
+    try:
+        found = retryPolicy.call(find)
+    except RETRY_EXCEPTIONS, lookupError:
+        raise OutcomeUnknown("no answer to the upload of " + description + ", and looking for it failed: " + str(lookupError))
+    if found is None:
+        raise e
+    return found
+
+##########################################################
+# Rate limiting and adaptive concurrency
+##########################################################
+
+class TokenBucket(object):
+    """Budget of `rate` units per second, with a burst of one second's worth.
+
+    A caller taking more than is available goes into debt and sleeps until
+    the bucket has refilled, so large uploads are paced instead of refused.
+    A rate of 0 disables the bucket.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def setRate(self, rate):
+        with self.lock:
+            self.rate = float(rate)
+            self.tokens = min(self.tokens, self.rate)
+
+class AdaptiveConcurrency(object):
+    """Limit on calls in flight, adjusted AIMD style.
+
+    The limit starts at one call and grows by one with every successful
+    call, doubling per round of calls, until the first throttling response.
+    From then on a successful call raises it by 1/limit, so it grows by about
+    one per round; a throttling response halves it. It never goes above the
+    maximum; a maximum of 0 means no limit.
+    """
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = 1.0
+        self.slowStart = True
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.maximum > 0 and self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, throttled, succeeded):
+        with self.condition:
+            self.active -= 1
+            if self.maximum > 0:
+                if throttled:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.slowStart = False
+                elif succeeded:
+                    step = 1.0 if self.slowStart else 1.0 / self.limit
+                    self.limit = min(float(self.maximum), self.limit + step)
+            self.condition.notify_all()
+
+class RateLimiter(object):
+    """Run-wide budget shared by every request sent to the service.
+
+    A request needs a concurrency slot, one request token and a token for
+    every byte it sends. Throttling answers shrink the concurrency limit
+    before RetryPolicy has to step in.
+
+    With a budget file, the byte budget follows the bytesPerSecond value in
+    that JSON file, so another process (runner.py) can change it while the
+    run goes on. The bytes per second actually sent are written back to the
+    same path plus '.usage', so that process can tell an idle run from one
+    using all it gets.
+    """
+    def __init__(self, requestsPerSecond=0, bytesPerSecond=0, maxConcurrency=0, budgetFile=None):
+        self.requestBucket = TokenBucket(requestsPerSecond)
+        self.byteBucket = TokenBucket(bytesPerSecond)
+        self.concurrency = AdaptiveConcurrency(maxConcurrency)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttles = 0
+        self.budgetFile = budgetFile
+        self.budgetStamp = None
+        self.budgetChecked = 0
+        # Bytes taken since the usage was last reported
+        self.bytesTaken = 0
+        self.usageStamp = time.time()
+
+    def reportUsage(self, bytesPerSecond):
+        try:
+            with open(self.budgetFile + '.usage.tmp', 'w') as f:
+                json.dump({'bytesPerSecond': bytesPerSecond}, f)
+            os.rename(self.budgetFile + '.usage.tmp', self.budgetFile + '.usage')
+        except (IOError, OSError):
+            pass
+
+    def checkBudget(self, size):
+        now = time.time()
+        with self.lock:
+            self.bytesTaken += size
+            if self.budgetFile is None or now - self.budgetChecked < BUDGET_CHECK_INTERVAL:
+                return
+            self.budgetChecked = now
+            if now - self.usageStamp >= BUDGET_CHECK_INTERVAL:
+                self.reportUsage(int(self.bytesTaken / (now - self.usageStamp)))
+                self.usageStamp = now
+                self.bytesTaken = 0
+            try:
+                stamp = os.stat(self.budgetFile).st_mtime
+                if stamp == self.budgetStamp:
+                    return
+                with open(self.budgetFile) as f:
+                    budget = json.load(f)
+            except (IOError, OSError, ValueError):
+                # Keep the budget we have; the file is written again soon
+                return
+            self.budgetStamp = stamp
+        self.byteBucket.setRate(budget.get('bytesPerSecond', 0))
+
+    def acquire(self, size):
+        self.checkBudget(size)
+        self.concurrency.acquire()
+        self.requestBucket.take(1)
+        if size > 0:
+            self.byteBucket.take(size)
+
+    def release(self, status):
+        # status is the HTTP status of the answer, or None when there was none
+        throttled = status in THROTTLE_STATUSES
+        with self.lock:
+            self.requests += 1
+            if throttled:
+                self.throttles += 1
+        self.concurrency.release(throttled, status is not None and 0 < status < 500)
+
+    def call(self, size, func, *args, **kwargs):
+        if getattr(threadState, 'limited', False):
+            # gdata follows redirects by calling itself; that is still the same request
+            return func(*args, **kwargs)
+        self.acquire(size)
+        threadState.limited = True
+        status = None
+        try:
+            result = func(*args, **kwargs)
+            status = 200
+            return result
+        except RETRY_EXCEPTIONS, e:
+            status = errorStatus(e)[0]
+            raise
+        finally:
+            threadState.limited = False
+            self.release(status)
+
+    def report(self):
+        if self.requests > 0:
+            print "*** " + str(self.requests) + " request(s) sent, " + str(self.throttles) + " throttled"
+
+rateLimiter = RateLimiter()
+
+def requestSize(data, media_source):
+    # Bytes a POST or PUT sends, as far as they are known up front
+    size = 0
+    if media_source is not None and media_source.content_length:
+        size += int(media_source.content_length)
+    if isinstance(data, gdata.MediaSource) and data.content_length:
+        # UpdatePhotoBlob PUTs the media itself
+        size += int(data.content_length)
+    if isinstance(data, basestring):
+        size += len(data)
+    return size
+
+##########################################################
+# Keep-alive HTTP connections
+##########################################################
+
+class ConnectionPool(object):
+    """Idle keep-alive connections shared by all clients of the run.
+
+    Connections are kept per (protocol, host, port). A connection is used
+    by one request at a time: it is taken out of the pool for the request
+    and put back once its response has been read completely.
+    """
+    def __init__(self, size=CONNECTION_POOL_SIZE, idleTimeout=CONNECTION_IDLE_TIMEOUT):
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+
+    def get(self, key):
+        # Most recently used first; connections idle for too long are likely closed by the server
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                connection, stamp = connections.pop()
+                if time.time() - stamp < self.idleTimeout:
+                    self.reused += 1
+                    return connection
+                connection.close()
+            self.opened += 1
+        return None
+
+    def put(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.size:
+                connections.append((connection, time.time()))
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection, stamp in connections:
+                    connection.close()
+            self.idle = {}
+
+    def report(self):
+        if self.opened + self.reused > 0:
+            print "*** " + str(self.opened) + " connection(s) opened, " + str(self.reused) + \
+                " request(s) sent over a kept-alive connection"
+
+connectionPool = ConnectionPool()
+
+class PooledResponse(object):
+    """HTTP response that hands its connection back to the pool once it has been read."""
+    def __init__(self, response, key, connection):
+        self.response = response
+        self.key = key
+        self.connection = connection
+
+    def read(self, *args):
+        data = self.response.read(*args)
+        if self.connection is not None and self.response.isclosed():
+            if self.response.will_close:
+                self.connection.close()
+            else:
+                connectionPool.put(self.key, self.connection)
+            self.connection = None
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+# Requests that do the same when sent twice; a POST sent again may create a second album or photo
+IDEMPOTENT_OPERATIONS = set(['GET', 'HEAD', 'PUT', 'DELETE'])
+
+def isReplayable(data):
+    # Only a body held in memory can be sent a second time
+    if isinstance(data, list):
+        return all(isReplayable(part) for part in data)
+    return data is None or isinstance(data, basestring)
+
+class KeepAliveMixin(object):
+    """Makes the gdata HTTP client reuse connections from connectionPool.
+
+    Requests through a proxy are left to ProxiedHttpClient and not pooled.
+    loadGdata() mixes this into atom.http.ProxiedHttpClient as KeepAliveHttpClient.
+    """
+    def _prepare_connection(self, url, headers):
+        if os.environ.get('%s_proxy' % url.protocol):
+            threadState.connection = None
+            return atom.http.ProxiedHttpClient._prepare_connection(self, url, headers)
+        key = (url.protocol, url.host, url.port)
+        connection = connectionPool.get(key)
+        reused = connection is not None
+        if connection is None:
+            connection = atom.http.HttpClient._prepare_connection(self, url, headers)
+        threadState.connection = (key, connection, reused)
+        return connection
+
+    def request(self, operation, url, data=None, headers=None):
+        while True:
+            threadState.connection = None
+            try:
+                response = atom.http.ProxiedHttpClient.request(self, operation, url, data, headers)
+            except (socket.error, httplib.HTTPException):
+                pooled = threadState.connection
+                threadState.connection = None
+                if pooled is None:
+                    raise
+                key, connection, reused = pooled
+                connection.close()
+                if reused and operation in IDEMPOTENT_OPERATIONS and isReplayable(data):
+                    # The server dropped the idle connection meanwhile; send again on another one.
+                    # The request may have arrived anyway, so a POST is left to fail instead
+                    continue
+                raise
+            pooled = threadState.connection
+            threadState.connection = None
+            if pooled is None:
+                return response
+            key, connection, reused = pooled
+            return PooledResponse(response, key, connection)
+
+class ThrottledMixin(object):
+    """Sends all PhotosService requests through the run-wide rate limiter.
+
+    loadGdata() mixes this into PhotosService as ThrottledPhotosService.
+    """
+    def Get(self, *args, **kwargs):
+        return rateLimiter.call(0, gdata.photos.service.PhotosService.Get, self, *args, **kwargs)
+
+    def Post(self, data, *args, **kwargs):
+        return rateLimiter.call(requestSize(data, kwargs.get('media_source')),
+            gdata.photos.service.PhotosService.Post, self, data, *args, **kwargs)
+
+    def Put(self, data, *args, **kwargs):
+        return rateLimiter.call(requestSize(data, kwargs.get('media_source')),
+            gdata.photos.service.PhotosService.Put, self, data, *args, **kwargs)
+
+    def Delete(self, *args, **kwargs):
+        return rateLimiter.call(0, gdata.photos.service.PhotosService.Delete, self, *args, **kwargs)
+
+# Calls that failed for good; retried once more at the end of the run
+deadLetters = []
+deadLettersLock = threading.Lock()
+
+def deadLetter(description, func, args, error):
+    log("-> giving up on " + description + ": " + str(error))
+    if isinstance(error, OutcomeUnknown):
+        # Sending it again could make a duplicate; it is only reported
+        func = None
+    with deadLettersLock:
+        deadLetters.append((description, func, args, error))
+
+def retryDeadLetters(gd_client):
+    global deadLetters
+    if not deadLetters:
+        return
+    failed = deadLetters
+    deadLetters = []
+    print "*** retrying " + str(len(failed)) + " failed item(s)"
+    for description, func, args, error in failed:
+        if func is None:
+            with deadLettersLock:
+                deadLetters.append((description, func, args, error))
+        else:
+            func(gd_client, *args)
+    for description, func, args, error in deadLetters:
+        print "*** failed: " + description + ": " + str(error)
+
+def queueUpload(gd_client, localPath, album, fileName, no_resize, replacing=None):
+    # Hand the file to the worker pool when running with --jobs, else upload right away
+    media = describeMedia(localPath)
+    if uploadPool is not None:
+        if not no_resize:
+            # Start resizing now, so it is done by the time a worker picks the file up
+            prepareResize(localPath, PICASA_MAX_FREE_IMAGE_DIMENSION, media)
+        uploadPool.submit(upload, localPath, album, fileName, no_resize, media, replacing)
+    else:
+        upload(gd_client, localPath, album, fileName, no_resize, media, replacing)
+
+def queueUploads(gd_client, uploads, no_resize):
+    # uploads: (local path, web album, file name, replaced WebPhoto or None) in order. Without
+    # --jobs, the resize pool works on the next images while one is uploaded here
+    prepared = 0
+    for i, (localPath, album, fileName, replacing) in enumerate(uploads):
+        if uploadPool is None and not no_resize and resizePool is not None:
+            ahead = i + 1 + resizeWorkers
+            for item in uploads[prepared:ahead]:
+                prepareResize(item[0], PICASA_MAX_FREE_IMAGE_DIMENSION, describeMedia(item[0]))
+            prepared = max(prepared, ahead)
+        queueUpload(gd_client, localPath, album, fileName, no_resize, replacing)
+
+gdataLock = threading.Lock()
+
+def loadGdata():
+    # Importing gdata takes most of the start-up time; runs that do not log in go without it
+    global atom, gdata, GPHOTOS_INVALID_ARGUMENT, GPHOTOS_INVALID_CONTENT_TYPE, GooglePhotosException
+    global VideoEntry, KeepAliveHttpClient, ThrottledPhotosService, RETRY_EXCEPTIONS
+    with gdataLock:
+        if gdata is not None:
+            return
+        import atom
+        import atom.http
+        import gdata
+        import gdata.photos.service
+        import gdata.media
+        import gdata.geo
+        from gdata.photos.service import GPHOTOS_INVALID_ARGUMENT, GPHOTOS_INVALID_CONTENT_TYPE, GooglePhotosException
+
+        VideoEntry = type('VideoEntry', (gdata.photos.PhotoEntry,), {})
+        gdata.photos.VideoEntry = VideoEntry
+        gdata.photos.service.PhotosService.InsertVideo = InsertVideo
+        KeepAliveHttpClient = type('KeepAliveHttpClient', (KeepAliveMixin, atom.http.ProxiedHttpClient), {})
+        ThrottledPhotosService = type('ThrottledPhotosService', (ThrottledMixin, gdata.photos.service.PhotosService), {})
+        RETRY_EXCEPTIONS = (GooglePhotosException, gdata.service.RequestError) + RETRY_EXCEPTIONS
 
 def login(email, password):
-    gd_client = gdata.photos.service.PhotosService()
+    loadGdata()
+    server = urlparse.urlsplit(picasaServer)
+    gd_client = ThrottledPhotosService(server=server.netloc, http_client=KeepAliveHttpClient())
+    gd_client.ssl = server.scheme == 'https'
+    if picasaServer != PICASA_SERVER:
+        # A stand-in for the service, such as the one of benchmark.py, also handles the login
+        gd_client.auth_service_url = picasaServer + '/accounts/ClientLogin'
     gd_client.email = email
     gd_client.password = password
     gd_client.source = 'palevich-photouploader'
     gd_client.ProgrammaticLogin()
     return gd_client
 
+def getFeedEntries(gd_client, uri):
+    # Feeds are served in pages; keep requesting until a short page comes back
+    start = 1
+    while True:
+        with stats.timed('listing'):
+            feed = retryPolicy.call(gd_client.GetFeed, uri, limit=FEED_PAGE_SIZE, start_index=start)
+        for entry in feed.entry:
+            yield entry
+        if len(feed.entry) < FEED_PAGE_SIZE:
+            return
+        start += len(feed.entry)
+
+class AlbumIndex(object):
+    """The web albums of the account, fetched once per run.
+
+    Albums created during the run are added in place, so lookups never need
+    to download the user feed again.
+    """
+    def __init__(self, gd_client):
+        self.lock = threading.Lock()
+        self.entries = []
+        self.byTitle = {}
+        for album in getFeedEntries(gd_client, '/data/feed/api/user/default?kind=album'):
+            self.add(album)
+
+    def add(self, album):
+        with self.lock:
+            self.entries.append(album)
+            title = album.title.text
+            if title in self.byTitle:
+                log("Duplicate web album:" + title)
+            else:
+                self.byTitle[title] = album
+
+    def find(self, title):
+        with self.lock:
+            return self.byTitle.get(title)
+
+def getAlbumIndex(gd_client):
+    global albumIndex
+    if albumIndex is None:
+        albumIndex = AlbumIndex(gd_client)
+    return albumIndex
+
 def protectWebAlbums(gd_client):
-    albums = gd_client.GetUserFeed()
-    for album in albums.entry:
+    for album in list(getAlbumIndex(gd_client).entries):
         # print 'title: %s, number of photos: %s, id: %s summary: %s access: %s\n' % (album.title.text,
         #  album.numphotos.text, album.gphoto_id.text, album.summary.text, album.access.text)
         needUpdate = False
@@ -195,45 +1277,36 @@ def protectWebAlbums(gd_client):
                 print "Could not update album: " + str(e)
 
 def getWebAlbums(gd_client):
-    albums = gd_client.GetUserFeed()
-    d = {}
-    for album in albums.entry:
-        title = album.title.text
-        if title in d:
-          print "Duplicate web album:" + title
-        else:
-          d[title] = album
-        # print 'title: %s, number of photos: %s, id: %s' % (album.title.text,
-        #    album.numphotos.text, album.gphoto_id.text)
-        #print vars(album)
-    return d
+    # Mapping of title to album; duplicate titles are reported by the index
+    return getAlbumIndex(gd_client).byTitle
 
 def findAlbum(gd_client, title):
-    albums = gd_client.GetUserFeed()
-    for album in albums.entry:
-        if album.title.text == title:
-            return album
-    return None
+    return getAlbumIndex(gd_client).find(title)
 
 def createAlbum(gd_client, title):
-    print "Creating album " + title
+    log("Creating album " + title)
     # public, private, protected. private == "anyone with link"
-    album = gd_client.InsertAlbum(title=title, summary='', access='private')
+    try:
+        album = gd_client.InsertAlbum(title=title, summary='', access='private')
+    except RETRY_EXCEPTIONS, e:
+        album = recoverPost(e, "album " + title, lambda: findWebAlbum(gd_client, title))
+    getAlbumIndex(gd_client).add(album)
     return album
 
-def findOrCreateAlbum(gd_client, title):
-    delay = 1
-    while True:
-        try:
-            album = findAlbum(gd_client, title)
-            if not album:
-                album = createAlbum(gd_client, title)
+def findWebAlbum(gd_client, title):
+    # Looks on the web rather than in the album index, for an album created without an answer
+    for album in getFeedEntries(gd_client, '/data/feed/api/user/default?kind=album'):
+        if album.title.text == title:
             return album
-        except gdata.photos.service.GooglePhotosException, e:
-            print "caught exception " + str(e)
-            print "sleeping for " + str(delay) + " seconds"
-            time.sleep(delay)
-            delay = delay * 2
+    return None
+
+def findOrCreateAlbum(gd_client, title):
+    def findOrCreate():
+        album = findAlbum(gd_client, title)
+        if not album:
+            album = createAlbum(gd_client, title)
+        return album
+    return retryPolicy.call(findOrCreate)
 
 def postPhoto(gd_client, album, filename):
     album_url = '/data/feed/api/user/%s/albumid/%s' % (gd_client.email, album.gphoto_id.text)
@@ -246,13 +1319,32 @@ def postPhotoToAlbum(gd_client, photo, album):
     photo = postPhoto(gd_client, album, args.source)
     return photo
 
-def getWebPhotosForAlbum(gd_client, album):
-    photos = gd_client.GetFeed(
-            '/data/feed/api/user/%s/albumid/%s?kind=photo' % (
-            gd_client.email, album.gphoto_id.text))
-    return photos.entry
+# Compact record of a web photo; holds only what syncing needs instead of the parsed XML entry
+WebPhoto = collections.namedtuple('WebPhoto', ['title', 'id', 'editLink', 'summary'])
 
-allExtensions = {}
+def webPhotoFromDict(d):
+    # Plans written before summaries were kept have no 'summary'
+    return WebPhoto(d['title'], d['id'], d['editLink'], d.get('summary'))
+
+def getWebPhotosForAlbum(gd_client, album):
+    # Generator: the album feed is fetched page by page, and only one page is held in memory
+    uri = '/data/feed/api/user/%s/albumid/%s?kind=photo' % (gd_client.email, album.gphoto_id.text)
+    for photo in getFeedEntries(gd_client, uri):
+        summary = None
+        if photo.summary is not None:
+            summary = photo.summary.text
+        yield WebPhoto(photo.title.text, photo.gphoto_id.text, photo.GetEditLink().href, summary)
+
+def getWebPhotoEntry(gd_client, webPhoto):
+    # Fetch the full entry of a single photo, e.g. to update its metadata; callers wrap it in their retries
+    return gd_client.GetEntry(webPhoto.editLink)
+
+def findWebPhotoEntry(gd_client, album, title):
+    # Full entry of the photo with this title in a web album, or None
+    for webPhoto in getWebPhotosForAlbum(gd_client, album):
+        if webPhoto.title == title:
+            return getWebPhotoEntry(gd_client, webPhoto)
+    return None
 
 # key: extension, value: type
 knownExtensions = {
@@ -274,77 +1366,321 @@ def getContentType(filename):
     else:
         return None
 
-def accumulateSeenExtensions(filename):
-    ext = os.path.splitext(filename)[1].lower()
-    if ext in allExtensions:
-        allExtensions[ext] = allExtensions[ext] + 1
-    else:
-        allExtensions[ext] = 1
-
 def isMediaFilename(filename):
-    accumulateSeenExtensions(filename)
     return getContentType(filename) != None
 
-def visit(arg, dirname, names):
-    # arg is the "hash" supplied in the "os.path.walk" call
-    # dirname is the directory we are walking into
-    # names is the content of the directory which we are free to modify to prevent it being crawled further
-    
-    # Skip hidden folders
-    basedirname = os.path.basename(dirname)
+def compileSkipDirs(patterns):
+    # All --skipdirs patterns folded into one regex, matched against directory names
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:' + regex + ')' for regex in patterns), re.M|re.I)
+
+def isSkippedDir(basedirname, skipRegex):
+    # Skip hidden folders, and folders defined by user
     if basedirname.startswith('.'):
-        # We skip this directory and everything underneath
-        del names[:]
-        return
-    
-     # Skip folders defined by user
-    if skipdirs is not None:
-        # Iterate over the list
-        for regex in skipdirs:
-            if re.match(regex, basedirname, re.M|re.I):
-                # We skip this directory and everything underneath
-                del names[:]
-                return
+        return True
+    return skipRegex is not None and skipRegex.match(basedirname) is not None
 
-    # Find all mediafiles that are:
+def listMediaDir(dirname):
+    # Returns the subdirectories (full paths) and the media files, as (name, size, mtime), of a directory.
+    # Media files are:
     #  - not hidden files
     #  - are a known media extension type
     #  - are actual files (not directories)
-    mediaFiles = [name for name in names if not name.startswith('.') and isMediaFilename(name) and
-        os.path.isfile(os.path.join(dirname, name))]
-    count = len(mediaFiles)
-    if count > 0:
-        arg[dirname] = {'files': sorted(mediaFiles)}
-
-def findMedia(source):
-    hash = {}
-    # Run over all files, calling the "visit" function for every file encountered, passing "hash" array as an argument to the visit function
-    os.path.walk(source, visit, hash)
-    return hash
-
-def findDupDirs(photos):
-    d = {}
-    for i in photos:
-        base = os.path.basename(i)
-        if base in d:
-            print "duplicate " + base + ":\n" + i + ":\n" + d[base]
-            dc = filecmp.dircmp(i, d[base])
-            print dc.diff_files
-        d[base] = i
-    # print [len(photos[i]['files']) for i in photos]
-
-def toBaseName(photos):
-    # Create a mapping between a pathname and an album name
-    d = {}
-    for i in photos:
-        base = os.path.basename(i)
-        if base in d:
-            print "duplicate " + base + ":\n" + i + ":\n" + d[base]['path']
-            raise Exception("duplicate base")
-        p = photos[i]
-        p['path'] = i
-        d[base] = p
-    return d
+    subdirs = []
+    mediaFiles = []
+    if HAS_SCANDIR:
+        for entry in scandir(dirname):
+            # The entry type comes from d_type, so only media files need a stat call
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif not entry.name.startswith('.') and isMediaFilename(entry.name) and entry.is_file():
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # removed since the directory was listed
+                    continue
+                mediaFiles.append((entry.name, st.st_size, st.st_mtime))
+    else:
+        for name in os.listdir(dirname):
+            path = os.path.join(dirname, name)
+            if not name.startswith('.') and isMediaFilename(name) and os.path.isfile(path):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed since the directory was listed
+                    continue
+                mediaFiles.append((name, st.st_size, st.st_mtime))
+            elif os.path.isdir(path) and not os.path.islink(path):
+                subdirs.append(path)
+    return subdirs, mediaFiles
+
+class LocalAlbum(object):
+    """The media files of one local directory, packed to stay small in very large trees.
+
+    The file names are sorted and joined into one string, with their offsets,
+    sizes and mtimes in arrays, so a file costs about 20 bytes plus its name
+    instead of a string object and a list slot. The parent directory is
+    interned and shared with the sibling albums. id is the integer id given
+    by MediaIndex.add(). Iterating gives the file names.
+    """
+    __slots__ = ('id', 'parent', 'name', 'names', 'offsets', 'sizes', 'mtimes')
+
+    def __init__(self, path, entries):
+        # entries are (name, size, mtime); a size of -1 means not known yet
+        parent, self.name = os.path.split(path)
+        self.parent = intern(parent) if isinstance(parent, str) else parent
+        self.id = None
+        entries = sorted(entries)
+        self.names = '\0'.join(entry[0] for entry in entries)
+        self.offsets = array.array('I', [0])
+        for entry in entries:
+            self.offsets.append(self.offsets[-1] + len(entry[0]) + 1)
+        # Doubles hold sizes exactly up to 2^53 bytes
+        self.sizes = array.array('d', (entry[1] for entry in entries))
+        self.mtimes = array.array('d', (entry[2] for entry in entries))
+
+    @classmethod
+    def fromNames(cls, path, names):
+        return cls(path, [(name, -1, 0) for name in names])
+
+    @property
+    def path(self):
+        return os.path.join(self.parent, self.name)
+
+    def fileName(self, i):
+        return self.names[self.offsets[i]:self.offsets[i + 1] - 1]
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __iter__(self):
+        for i in xrange(len(self.sizes)):
+            yield self.fileName(i)
+
+    def entries(self):
+        for i in xrange(len(self.sizes)):
+            yield self.fileName(i), int(self.sizes[i]), self.mtimes[i]
+
+    def find(self, name):
+        # Binary search on the sorted names; -1 when the file is not in the album
+        lo, hi = 0, len(self.sizes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.fileName(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.sizes) and self.fileName(lo) == name:
+            return lo
+        return -1
+
+    def __contains__(self, name):
+        return self.find(name) >= 0
+
+    def stat(self, name):
+        # (size, mtime) of a file as the scan found it; files the scan did not stat are asked now
+        i = self.find(name)
+        if i < 0 or self.sizes[i] < 0:
+            st = os.stat(os.path.join(self.path, name))
+            return st.st_size, st.st_mtime
+        return int(self.sizes[i]), self.mtimes[i]
+
+    def without(self, paths):
+        # The album minus the files whose full path is in paths
+        path = self.path
+        return LocalAlbum(path, [entry for entry in self.entries() if os.path.join(path, entry[0]) not in paths])
+
+def scanMedia(source, threads=SCAN_THREADS):
+    """Generator of a LocalAlbum for each directory holding media.
+
+    Subtrees are listed in parallel threads and directories are yielded as
+    soon as they are found, in no particular order, so work on the first
+    albums can start while the scan goes on.
+    """
+    skipRegex = compileSkipDirs(skipdirs)
+    pending = Queue.Queue()
+    results = Queue.Queue()
+    lock = threading.Lock()
+    # Directories queued or being listed; the scan is over when it drops to zero
+    outstanding = [1]
+
+    def work():
+        while True:
+            dirname = pending.get()
+            if dirname is None:
+                return
+            subdirs = []
+            try:
+                if not isSkippedDir(os.path.basename(dirname), skipRegex):
+                    try:
+                        with stats.timed('scan'):
+                            subdirs, mediaFiles = listMediaDir(dirname)
+                    except OSError:
+                        # unreadable directory, skipped like os.path.walk did
+                        mediaFiles = []
+                    if mediaFiles:
+                        results.put(LocalAlbum(dirname, mediaFiles))
+            except Exception:
+                # raised again by the consumer; the scan must still come to an end
+                subdirs = []
+                results.put(sys.exc_info())
+            finally:
+                with lock:
+                    outstanding[0] += len(subdirs) - 1
+                    finished = outstanding[0] == 0
+                for subdir in subdirs:
+                    pending.put(subdir)
+                if finished:
+                    results.put(None)
+
+    workers = [threading.Thread(target=work) for i in range(max(1, threads))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    pending.put(source)
+    try:
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            if isinstance(result, tuple):
+                raise result[0], result[1], result[2]
+            yield result
+    finally:
+        for worker in workers:
+            pending.put(None)
+        for worker in workers:
+            worker.join()
+
+def findMedia(source, threads=SCAN_THREADS):
+    # All albums of the tree, sorted by path
+    return sorted(scanMedia(source, threads), key=lambda album: album.path)
+
+##########################################################
+# Duplicate detection
+##########################################################
+
+def partialHash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read(PARTIAL_HASH_SIZE)).hexdigest()
+
+def groupBy(paths, key):
+    groups = {}
+    for path in paths:
+        groups.setdefault(key(path), []).append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+def findDuplicateFiles(paths):
+    """Groups of byte-identical files among paths, each sorted by path.
+
+    Candidates are narrowed down by size, then by a hash of their first
+    PARTIAL_HASH_SIZE bytes, and only then by a hash of the whole file, so
+    most files are never read and no file is read more than about once.
+    """
+    duplicates = []
+    for sameSize in groupBy(paths, os.path.getsize):
+        for samePrefix in groupBy(sameSize, partialHash):
+            if os.path.getsize(samePrefix[0]) <= PARTIAL_HASH_SIZE:
+                # the partial hash covered the whole file
+                duplicates.append(sorted(samePrefix))
+            else:
+                duplicates.extend(sorted(group) for group in groupBy(samePrefix, fileHash))
+    return sorted(duplicates)
+
+def findDupDirs(albums):
+    # albums are LocalAlbums, as returned by findMedia.
+    # Returns the groups of identical files, and the groups of directories whose media are identical
+    paths = [os.path.join(album.path, f) for album in albums for f in album]
+    dupFiles = findDuplicateFiles(paths)
+    contentId = {}
+    for n, group in enumerate(dupFiles):
+        for path in group:
+            contentId[path] = n
+    # Only a directory made up of duplicated files can be a duplicate directory
+    bySignature = {}
+    for album in albums:
+        ids = [contentId.get(os.path.join(album.path, f)) for f in album]
+        if ids and None not in ids:
+            bySignature.setdefault(tuple(sorted(ids)), []).append(album.path)
+    dupDirs = sorted(sorted(group) for group in bySignature.values() if len(group) > 1)
+    for group in dupFiles:
+        print "duplicate files:\n  " + "\n  ".join(group)
+    for group in dupDirs:
+        print "duplicate directories:\n  " + "\n  ".join(group)
+    return dupFiles, dupDirs
+
+def discoverMedia(source, skip_duplicates, threads=SCAN_THREADS):
+    # LocalAlbums to sync, sorted by path: of several directories with the same
+    # base name, the same one gets the album in every run whatever order the
+    # scanner found them in
+    albums = findMedia(source, threads)
+    if not skip_duplicates:
+        return albums
+    dupFiles, dupDirs = findDupDirs(albums)
+    # Keep the first file of each group of identical files
+    skipped = set(path for group in dupFiles for path in group[1:])
+    print "*** skipping " + str(len(skipped)) + " duplicate file(s)"
+    found = []
+    for album in albums:
+        if skipped:
+            album = album.without(skipped)
+        if len(album) > 0:
+            found.append(album)
+    return found
+
+class MediaIndex(object):
+    """The local albums of a run by album name, the base name of their directory.
+
+    Albums get integer ids in the order they are added. Iterating gives the
+    album names, so the index can stand in for a dict of albums, e.g. in
+    compareLocalToWeb().
+    """
+    def __init__(self):
+        self.albums = []
+        self.ids = {}
+
+    def add(self, album):
+        # Returns the album name, or None when another directory already has
+        # that name and the directory is skipped; albums are added sorted by
+        # path, so the directory that sorts first keeps the name
+        if album.name in self.ids:
+            other = self[album.name]
+            print "duplicate " + album.name + ":\n" + album.path + ":\n" + other.path
+            if findDupDirs([album, other])[1]:
+                print "-> same content, skipping " + album.path
+            else:
+                print "-> different content, skipping " + album.path + " (rename one of the directories to upload both)"
+            return None
+        album.id = len(self.albums)
+        self.albums.append(album)
+        self.ids[album.name] = album.id
+        return album.name
+
+    def __getitem__(self, name):
+        return self.albums[self.ids[name]]
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.albums)
+
+    def byId(self, id):
+        return self.albums[id]
+
+    def fileCount(self):
+        return sum(len(album) for album in self.albums)
+
+def toBaseName(albums):
+    # Create a mapping between album name and album
+    index = MediaIndex()
+    for album in albums:
+        index.add(album)
+    return index
 
 def compareLocalToWeb(local, web):
     localOnly = []
@@ -374,183 +1710,1302 @@ def compareLocalToWebDir(localAlbum, webPhotoDict):
             webOnly.append(i)
     return {'localOnly' : localOnly, 'both' : both, 'webOnly' : webOnly}
 
+##########################################################
+# Local sync manifest
+##########################################################
+
+def photoIdOf(entry):
+    # Photo entries carry gphoto:id; plain entries (videos) only have the atom id URL
+    if getattr(entry, 'gphoto_id', None) is not None:
+        return entry.gphoto_id.text
+    return entry.id.text.rsplit('/', 1)[-1]
+
+def fileHash(path):
+    # Content hash used to tell edited files from touched ones, and to spot renames
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+class Manifest(object):
+    """SQLite record of uploaded files, keyed by album and file name.
+
+    Each row holds the size, mtime and content hash the file had when it was
+    uploaded (or found on the web) and the remote photo id. An album whose
+    local files all match their rows is unchanged, so its remote photo
+    listing can be skipped.
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        # Upload workers record their results too, so the connection is shared under a lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # File names are byte strings; keep them that way on the way in and out
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+            'album TEXT, filename TEXT, size INTEGER, mtime REAL, photoid TEXT, hash TEXT, '
+            'PRIMARY KEY (album, filename))')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(files)')]
+        if 'hash' not in columns:
+            # manifest written before content hashes were recorded
+            self.db.execute('ALTER TABLE files ADD COLUMN hash TEXT')
+        # Progress of the files queued for upload; see journal()
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal ('
+            'album TEXT, filename TEXT, state TEXT, photoid TEXT, session TEXT, replaces TEXT, stamp REAL, '
+            'PRIMARY KEY (album, filename))')
+        self.db.commit()
+
+    def albumFiles(self, album):
+        # key: file name, value: (size, mtime, photo id, hash)
+        with self.lock:
+            rows = self.db.execute('SELECT filename, size, mtime, photoid, hash FROM files WHERE album = ?',
+                (album,)).fetchall()
+        return dict((row[0], row[1:]) for row in rows)
+
+    def isFileClean(self, known, localAlbum, f):
+        # Uploaded, and not changed locally since
+        if f not in known:
+            return False
+        size, mtime, photoId, digest = known[f]
+        return photoId is not None and localAlbum.stat(f) == (size, mtime)
+
+    def isAlbumClean(self, album, localAlbum):
+        known = self.albumFiles(album)
+        if len(known) != len(localAlbum):
+            return False
+        for f in localAlbum:
+            if not self.isFileClean(known, localAlbum, f):
+                return False
+        return True
+
+    def record(self, album, filename, localPath, photoId, digest=None):
+        st = os.stat(localPath)
+        row = (album, filename, st.st_size, st.st_mtime, photoId, digest or fileHash(localPath))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', row)
+            self.db.commit()
+
+    def recordMany(self, album, files, known, digests=None):
+        # The hash is only computed again when the size or mtime changed since it was recorded,
+        # and it is not among the digests (file name -> hash) computed already
+        rows = []
+        for filename, localPath, photoId in files:
+            st = os.stat(localPath)
+            old = known.get(filename)
+            if digests and filename in digests:
+                digest = digests[filename]
+            elif old is not None and old[0] == st.st_size and old[1] == st.st_mtime and old[3] is not None:
+                digest = old[3]
+            else:
+                digest = fileHash(localPath)
+            rows.append((album, filename, st.st_size, st.st_mtime, photoId, digest))
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.db.commit()
+
+    def journalMany(self, album, files):
+        # files: (file name, id of the web photo it replaces or None); rows of an earlier run are kept
+        rows = [(album, filename, 'queued', None, None, replaces, time.time()) for filename, replaces in files]
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO journal VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.commit()
+
+    def journal(self, album, filename, state, photoId=None, session=None):
+        """Record the state of a file: queued, resized, uploading or done.
+
+        Written before each step is taken, so after an interruption
+        'uploading' means the file may or may not have reached the web.
+        """
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO journal (album, filename) VALUES (?, ?)', (album, filename))
+            self.db.execute('UPDATE journal SET state = ?, photoid = COALESCE(?, photoid), '
+                'session = COALESCE(?, session), stamp = ? WHERE album = ? AND filename = ?',
+                (state, photoId, session, time.time(), album, filename))
+            self.db.commit()
+
+    def journalEntries(self, album):
+        # key: file name, value: (state, photo id, upload session, replaced photo id)
+        with self.lock:
+            rows = self.db.execute('SELECT filename, state, photoid, session, replaces FROM journal WHERE album = ?',
+                (album,)).fetchall()
+        return dict((row[0], row[1:]) for row in rows)
+
+    def journalSession(self, album, filename):
+        # Resumable upload session of a file interrupted while uploading
+        with self.lock:
+            row = self.db.execute("SELECT session FROM journal WHERE album = ? AND filename = ? AND state = 'uploading'",
+                (album, filename)).fetchone()
+        return row[0] if row is not None else None
+
+    def unfinishedFiles(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM journal WHERE state != 'done'").fetchone()[0]
+
+    def clearJournal(self):
+        # Finished files are in the files table; unfinished ones stay for the next run
+        with self.lock:
+            self.db.execute("DELETE FROM journal WHERE state = 'done'")
+            self.db.commit()
+
+    def finishJournal(self, album, filenames):
+        # Files the web album listing showed to be there after all
+        with self.lock:
+            self.db.executemany("UPDATE journal SET state = 'done' WHERE album = ? AND filename = ?",
+                [(album, f) for f in filenames])
+            self.db.commit()
+
+    def vanishedFiles(self, localAlbums):
+        # (album, file name, size, photo id, hash) of the hashed rows whose file is no longer in its directory
+        with self.lock:
+            rows = self.db.execute('SELECT album, filename, size, photoid, hash FROM files '
+                'WHERE hash IS NOT NULL AND photoid IS NOT NULL').fetchall()
+        return [row for row in rows if row[0] not in localAlbums or row[1] not in localAlbums[row[0]]]
+
+    def forget(self, album, filename):
+        with self.lock:
+            self.db.execute('DELETE FROM files WHERE album = ? AND filename = ?', (album, filename))
+            self.db.commit()
+
+    def forgetOthers(self, album, filenames):
+        # Drop rows of files that no longer exist locally
+        keep = set(filenames)
+        stale = [(album, f) for f in self.albumFiles(album) if f not in keep]
+        stale.extend((album, f) for f in self.journalEntries(album) if f not in keep)
+        with self.lock:
+            self.db.executemany('DELETE FROM files WHERE album = ? AND filename = ?', stale)
+            self.db.executemany('DELETE FROM journal WHERE album = ? AND filename = ?', stale)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class VanishedFiles(object):
+    """Uploaded files that are no longer in their directory, by size.
+
+    Taken from the manifest before any album is synced, so a file moved to
+    another directory is still known by its content there and can take its
+    web photo along. An entry is handed out once.
+    """
+    def __init__(self, rows):
+        self.bySize = {}
+        for album, filename, size, photoId, digest in rows:
+            self.bySize.setdefault(size, []).append((album, filename, photoId, digest))
+
+    def hasSize(self, size):
+        return bool(self.bySize.get(size))
+
+    def claim(self, size, digest, album):
+        # (album, file name, photo id) of a vanished file of another album with this content, or None
+        for entry in self.bySize.get(size, []):
+            if entry[0] != album and entry[3] == digest:
+                self.bySize[size].remove(entry)
+                return entry[:3]
+        return None
+
+    def discard(self, album, filename):
+        for entries in self.bySize.values():
+            for entry in entries:
+                if entry[:2] == (album, filename):
+                    entries.remove(entry)
+                    return
+
+def detectChanges(known, localAlbum, webPhotoDict, report, digests, elsewhere=None):
+    """Sort the files of an album into unchanged, edited, renamed, moved and new ones.
+
+    known are the manifest rows of the album. A file on both sides whose size
+    or mtime differs from its row is hashed, and is edited only when the
+    hash differs too. A local-only file is hashed only when a file of the
+    same size vanished locally but is still on the web, or vanished from
+    another album (elsewhere, a VanishedFiles); equal hashes make it a
+    rename or a move of that file. Returns (unchanged, edited, [(old, new)],
+    [((album, old, photo id), new)], new); the hashes computed are left in
+    digests, by file name.
+    """
+    unchanged = []
+    edited = []
+    for f in report['both']:
+        localPath = os.path.join(localAlbum.path, f)
+        row = known.get(f)
+        if row is None or localAlbum.stat(f) == (row[0], row[1]):
+            # Not seen before, or untouched: trust the web copy
+            unchanged.append(f)
+        elif row[3] is None:
+            edited.append(f)
+        else:
+            digests[f] = fileHash(localPath)
+            if row[3] == digests[f]:
+                unchanged.append(f)
+            else:
+                edited.append(f)
+
+    # Files gone locally but still on the web, by size
+    vanished = {}
+    for f, row in known.items():
+        if f not in localAlbum and f in webPhotoDict and row[3] is not None:
+            vanished.setdefault(row[0], []).append((f, row[3]))
+
+    renamed = []
+    moved = []
+    new = []
+    for f in report['localOnly']:
+        localPath = os.path.join(localAlbum.path, f)
+        size = localAlbum.stat(f)[0]
+        candidates = vanished.get(size)
+        if candidates or (elsewhere is not None and elsewhere.hasSize(size)):
+            digests[f] = digest = fileHash(localPath)
+            match = [c for c in candidates or [] if c[1] == digest]
+            if match:
+                candidates.remove(match[0])
+                if elsewhere is not None:
+                    elsewhere.discard(localAlbum.name, match[0][0])
+                renamed.append((match[0][0], f))
+                continue
+            source = elsewhere.claim(size, digest, localAlbum.name) if elsewhere is not None else None
+            if source is not None:
+                moved.append((source, f))
+                continue
+        new.append(f)
+    return unchanged, edited, renamed, moved, new
+
+def renameWebPhoto(gd_client, webPhoto, title):
+    entry = retryPolicy.call(getWebPhotoEntry, gd_client, webPhoto)
+    entry.title = atom.Title(text=title)
+    return retryPolicy.call(gd_client.UpdatePhotoMetadata, entry)
+
+def moveWebPhoto(gd_client, source, webAlbum, title):
+    # source is (album, file name, photo id); the photo goes to webAlbum under a new title
+    album, filename, photoId = source
+    oldAlbum = findAlbum(gd_client, album)
+    if oldAlbum is None:
+        raise GooglePhotosException({'status': 404, 'body': 'no album ' + album, 'reason': 'Not Found'})
+    uri = '/data/entry/api/user/%s/albumid/%s/photoid/%s' % (gd_client.email, oldAlbum.gphoto_id.text, photoId)
+    entry = retryPolicy.call(gd_client.GetEntry, uri)
+    entry.albumid = gdata.photos.Albumid(text=webAlbum.gphoto_id.text)
+    entry.title = atom.Title(text=title)
+    return retryPolicy.call(gd_client.UpdatePhotoMetadata, entry)
+
 def syncDirs(gd_client, dirs, local, web, no_resize, forcemetadata):
     for dir in dirs:
         syncDir(gd_client, dir, local[dir], web[dir], no_resize, forcemetadata)
 
-def syncDir(gd_client, dir, localAlbum, webAlbum, no_resize, forcemetadata):
+def resumeAlbum(dir, localAlbum):
+    """Files of an album an interrupted run did not finish, taken from the journal.
+
+    Files recorded in the manifest are done. Files still queued or resized
+    never reached the web, and a resumable upload continues its session.
+    Returns None when only the web album can tell: a file was being POSTed
+    or replaced at the interruption, or is in neither the journal nor the
+    manifest.
+    """
+    entries = manifest.journalEntries(dir)
+    if not entries:
+        return None
+    known = manifest.albumFiles(dir)
+    todo = []
+    for f in localAlbum:
+        state, photoId, session, replaces = entries.get(f, (None, None, None, None))
+        if state != 'done' and replaces is not None:
+            return None
+        if state == 'done' or (state is None and manifest.isFileClean(known, localAlbum, f)):
+            continue
+        if state in ('queued', 'resized') or (state == 'uploading' and session is not None):
+            todo.append(f)
+            continue
+        return None
+    return todo
+
+def diffAlbum(gd_client, dir, localAlbum, webAlbum, forcemetadata):
+    """Compare a local directory with its web album, without changing anything on the web or in the manifest.
+
+    Returns None when the manifest shows the directory is unchanged; else a
+    dict with the unique web photos by title ('webPhotos'), the files on
+    both sides ('both'), the ones of them unchanged since their upload
+    ('unchanged'), files edited locally ('edited'), renamed files as
+    (old, new) pairs ('renamed'), files to upload ('localOnly') and the
+    content hashes computed on the way ('digests').
+    recordDiff() brings the manifest up to date with the diff.
+    """
+    # Nothing changed locally since the last run: no need to list the web album
+    if manifest is not None and not forcemetadata and manifest.isAlbumClean(dir, localAlbum):
+        return None
+
+    # An interrupted run left this album half done: the journal may tell what is left
+    if manifest is not None and not forcemetadata:
+        todo = resumeAlbum(dir, localAlbum)
+        if todo is not None:
+            log("Resuming album: " + dir + ", " + str(len(todo)) + " file(s) left")
+            return {'webPhotos': {}, 'both': [], 'unchanged': [], 'edited': [], 'renamed': [], 'moved': [],
+                    'localOnly': todo, 'digests': {}, 'resumed': True}
+
     webPhotos = getWebPhotosForAlbum(gd_client, webAlbum)
     webPhotoDict = {}
     
     # Filter out duplicates in the web album
     for photo in webPhotos:
-        title = photo.title.text
+        title = photo.title
         if title in webPhotoDict:
-            print "duplicate web photo: " + webAlbum.title.text + " " + title
+            log("duplicate web photo: " + webAlbum.title.text + " " + title)
         else:
             webPhotoDict[title] = photo
             
     # Now that we have unique list of web photos (duplicates filtered), compare
     # with the files we have locally for that album...
-    report = compareLocalToWebDir(localAlbum['files'], webPhotoDict)
+    report = compareLocalToWebDir(localAlbum, webPhotoDict)
+
+    diff = {'webPhotos': webPhotoDict, 'both': report['both'], 'unchanged': [], 'edited': [], 'renamed': [],
+            'moved': [], 'localOnly': report['localOnly'], 'digests': {}}
+    if manifest is not None:
+        known = manifest.albumFiles(dir)
+        diff['unchanged'], diff['edited'], diff['renamed'], diff['moved'], diff['localOnly'] = detectChanges(known,
+            localAlbum, webPhotoDict, report, diff['digests'], vanishedFiles)
+    return diff
+
+def recordDiff(dir, localAlbum, diff):
+    # Remember the files of a diff that are already on the web, and forget the ones gone locally.
+    # A diff taken from the journal has not seen the web album, so there is nothing to learn from it
+    if manifest is None or diff.get('resumed'):
+        return
+    webPhotoDict = diff['webPhotos']
+    manifest.forgetOthers(dir, localAlbum)
+    manifest.recordMany(dir, [(f, os.path.join(localAlbum.path, f), webPhotoDict[f].id)
+        for f in diff['unchanged']], manifest.albumFiles(dir), diff['digests'])
+    manifest.finishJournal(dir, diff['unchanged'])
+
+def renameFile(gd_client, dir, localPath, webPhoto, new, digest=None):
+    # Renamed files keep their web photo; only its title changes. Returns False when that failed
+    log("Renamed: " + webPhoto.title + " -> " + new)
+    try:
+        renameWebPhoto(gd_client, webPhoto, new)
+    except RETRY_EXCEPTIONS, e:
+        log("-> rename failed: " + str(e))
+        return False
+    if manifest is not None:
+        manifest.record(dir, new, localPath, webPhoto.id, digest)
+    return True
+
+def moveFile(gd_client, dir, localPath, webAlbum, source, new, digest=None):
+    # A file moved here from another directory takes its web photo along. Returns False when that failed
+    log("Moved: " + source[0] + "/" + source[1] + " -> " + dir + "/" + new)
+    try:
+        moveWebPhoto(gd_client, source, webAlbum, new)
+    except RETRY_EXCEPTIONS, e:
+        log("-> move failed: " + str(e))
+        return False
+    if manifest is not None:
+        manifest.forget(source[0], source[1])
+        manifest.record(dir, new, localPath, source[2], digest)
+    return True
+
+# Number of --forcemetadata updates left out because the web photo was already up to date
+metadataSkipped = 0
+
+def isMetadataChanged(webPhoto, fileName, summary):
+    # Title and summary we would write, compared with what the album feed reported
+    if webPhoto.title != fileName:
+        return True
+    return summary is not None and decodeText(summary).strip() != decodeText(webPhoto.summary or '').strip()
+
+def putMetadata(gd_client, webPhoto, fileName, summary):
+    # Failures go to the dead letters, whether or not this runs in the metadata pool
+    try:
+        gd_photo = retryPolicy.call(getWebPhotoEntry, gd_client, webPhoto)
+        gd_photo.title = atom.Title(text=fileName)
+        if summary is not None:
+            gd_photo.summary = atom.Summary(text=summary, summary_type='text')
+        with stats.timed('metadata-put'):
+            retryPolicy.call(gd_client.UpdatePhotoMetadata, gd_photo)
+    except RETRY_EXCEPTIONS, e:
+        deadLetter(fileName, putMetadata, (webPhoto, fileName, summary), e)
+
+def updateMetadataFiles(gd_client, files):
+    # files is a list of (local path, file name, WebPhoto); only real differences are written
+    global metadataSkipped
+    media = dict((localPath, describeMedia(localPath)) for localPath, file, webPhoto in files)
+    if not hasPyexiv2() and hasExifTool():
+        # exiftool is the reader: ask it only about the files whose header did not tell us enough
+        prefetchExifMetadata([path for path in media if not media[path].metadataRead])
+    for localPath, file, webPhoto in files:
+        summary = readDescription(localPath, media[localPath])
+        if not isMetadataChanged(webPhoto, file, summary):
+            metadataSkipped += 1
+            continue
+        log('Metadata update for: ' + file)
+        if metadataPool is not None:
+            metadataPool.submit(putMetadata, webPhoto, file, summary)
+        else:
+            putMetadata(gd_client, webPhoto, file, summary)
+    with exifPrefetchedLock:
+        exifPrefetched.clear()
+
+def syncDir(gd_client, dir, localAlbum, webAlbum, no_resize, forcemetadata):
+    try:
+        diff = diffAlbum(gd_client, dir, localAlbum, webAlbum, forcemetadata)
+    except RETRY_EXCEPTIONS, e:
+        # The web album could not be listed; the other albums go on
+        deadLetter("album " + dir, syncDir, (dir, localAlbum, webAlbum, no_resize, forcemetadata), e)
+        return
+    if diff is None:
+        log("Unchanged album: " + dir)
+        return
+    recordDiff(dir, localAlbum, diff)
+    webPhotoDict = diff['webPhotos']
+    localOnly = list(diff['localOnly'])
+
+    for old, new in diff['renamed']:
+        if not renameFile(gd_client, dir, os.path.join(localAlbum.path, new), webPhotoDict[old], new, diff['digests'].get(new)):
+            # Fall back to uploading it as a new file
+            localOnly.append(new)
+
+    for source, new in diff['moved']:
+        if not moveFile(gd_client, dir, os.path.join(localAlbum.path, new), webAlbum, source, new, diff['digests'].get(new)):
+            localOnly.append(new)
+
+    if manifest is not None:
+        manifest.journalMany(dir, [(f, webPhotoDict[f].id) for f in diff['edited']] + [(f, None) for f in localOnly])
+
+    # Replace the web copy of files edited locally
+    uploads = []
+    for f in diff['edited']:
+        localPath = os.path.join(localAlbum.path, f)
+        log("Edited: " + f)
+        # Hashed by detectChanges already; the manifest records that hash after the upload
+        describeMedia(localPath).digest = diff['digests'].get(f)
+        uploads.append((localPath, webAlbum, f, webPhotoDict[f]))
 
     # Upload all files that we have locally only
-    localOnly = report['localOnly']
-    for f in localOnly:
-        localPath = os.path.join(localAlbum['path'], f)
-        upload(gd_client, localPath, webAlbum, f, no_resize)
+    uploads.extend((os.path.join(localAlbum.path, f), webAlbum, f, None) for f in localOnly)
+    queueUploads(gd_client, uploads, no_resize)
 
     # Force metadata update for pictures existing on both locations?
     if forcemetadata:
-        filesBoth = report['both']
-        for file in filesBoth:
-            localPath = os.path.join(localAlbum['path'], file)
-            print 'Metadata update for: ' + file
-            gd_photo = updatemetadata(gd_client, webPhotoDict[file], localPath, file)
-            gd_client.UpdatePhotoMetadata(gd_photo)          
+        updateMetadataFiles(gd_client, [(os.path.join(localAlbum.path, f), f, webPhotoDict[f])
+            for f in diff['both']])
 
 def uploadDirs(gd_client, dirs, local, no_resize):
     for dir in dirs:
         uploadDir(gd_client, dir, local[dir], no_resize)
 
 def uploadDir(gd_client, dir, localAlbum, no_resize):
-    webAlbum = findOrCreateAlbum(gd_client, dir)
-    for f in localAlbum['files']:
-        localPath = os.path.join(localAlbum['path'], f)
-        upload(gd_client, localPath, webAlbum, f, no_resize)
+    try:
+        webAlbum = findOrCreateAlbum(gd_client, dir)
+    except RETRY_EXCEPTIONS, e:
+        deadLetter("album " + dir, uploadDir, (dir, localAlbum, no_resize), e)
+        return
+    files = []
+    for f in localAlbum:
+        localPath = os.path.join(localAlbum.path, f)
+        size = localAlbum.stat(f)[0]
+        if vanishedFiles is not None and vanishedFiles.hasSize(size):
+            # Moved here from another directory?
+            digest = fileHash(localPath)
+            source = vanishedFiles.claim(size, digest, dir)
+            if source is not None and moveFile(gd_client, dir, localPath, webAlbum, source, f, digest):
+                continue
+        files.append(f)
+    if manifest is not None:
+        manifest.journalMany(dir, [(f, None) for f in files])
+    queueUploads(gd_client, [(os.path.join(localAlbum.path, f), webAlbum, f, None) for f in files], no_resize)
+
+##########################################################
+# Watch mode
+##########################################################
+
+class SettleQueue(object):
+    """Files reported as changed, held back until they stop changing.
+
+    A file is ready once two stats taken at least `settle` seconds apart
+    agree on size and mtime, so files still being written or copied are
+    not uploaded half-way.
+    """
+    def __init__(self, settle):
+        self.settle = settle
+        self.lock = threading.Lock()
+        # key: path, value: [time of the next check, (size, mtime) at the last check]
+        self.pending = {}
+
+    def touched(self, path):
+        with self.lock:
+            state = self.pending.setdefault(path, [0, None])
+            state[0] = time.time() + self.settle
+
+    def ready(self):
+        now = time.time()
+        settled = []
+        with self.lock:
+            for path, state in self.pending.items():
+                if state[0] > now:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # deleted or moved away before it settled
+                    del self.pending[path]
+                    continue
+                snapshot = (st.st_size, st.st_mtime)
+                if snapshot == state[1]:
+                    settled.append(path)
+                    del self.pending[path]
+                else:
+                    state[0] = now + self.settle
+                    state[1] = snapshot
+        return settled
+
+def isWatchedFile(source, path, skipRegex):
+    # Same rules as the scanner: no hidden or skipped directory on the way, media files only
+    dirname, name = os.path.split(path)
+    if name.startswith('.') or not isMediaFilename(name):
+        return False
+    relative = os.path.relpath(dirname, source)
+    parts = [os.path.basename(os.path.normpath(source))]
+    if relative != os.curdir:
+        parts.extend(relative.split(os.sep))
+    for part in parts:
+        if isSkippedDir(part, skipRegex):
+            return False
+    return True
+
+def startInotifyWatch(source, changes):
+    class Handler(pyinotify.ProcessEvent):
+        def process_default(self, event):
+            if not event.dir:
+                changes.touched(event.pathname)
+            elif event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+                # A directory moved in comes with no events for the files already in it,
+                # and files may land in a new one before its watch is added: list it
+                for album in scanMedia(event.pathname):
+                    for name in album:
+                        changes.touched(os.path.join(album.path, name))
+    manager = pyinotify.WatchManager()
+    # IN_CREATE is what has auto_add watch new directories
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY | pyinotify.IN_CREATE
+    notifier = pyinotify.ThreadedNotifier(manager, Handler())
+    notifier.daemon = True
+    notifier.start()
+    manager.add_watch(source, mask, rec=True, auto_add=True)
+    return notifier
+
+def startPollingWatch(source, changes, interval):
+    # Without inotify: rescan the tree now and then and compare sizes and mtimes
+    def snapshot():
+        files = {}
+        for album in scanMedia(source):
+            for name, size, mtime in album.entries():
+                files[os.path.join(album.path, name)] = (size, mtime)
+        return files
+    def poll():
+        previous = snapshot()
+        while True:
+            time.sleep(interval)
+            current = snapshot()
+            for path, state in current.items():
+                if previous.get(path) != state:
+                    changes.touched(path)
+            previous = current
+    poller = threading.Thread(target=poll)
+    poller.daemon = True
+    poller.start()
+    return poller
+
+def uploadChanged(gd_client, paths, no_resize, localAlbums):
+    # localAlbums is the MediaIndex of the run; a directory it skipped for its name stays skipped
+    byDir = {}
+    for path in paths:
+        byDir.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+    for dirname in sorted(byDir):
+        dir = os.path.basename(dirname)
+        names = sorted(byDir[dirname])
+        if dir in localAlbums and localAlbums[dir].path != dirname:
+            log("Ignoring changes in " + dirname + ": album " + dir + " is synced from " + localAlbums[dir].path)
+            continue
+        if dir not in localAlbums:
+            localAlbums.add(LocalAlbum.fromNames(dirname, names))
+        webAlbum = findAlbum(gd_client, dir)
+        if webAlbum is None:
+            uploadDir(gd_client, dir, LocalAlbum.fromNames(dirname, names), no_resize)
+            continue
+        known = {}
+        if manifest is not None:
+            known = manifest.albumFiles(dir)
+        if manifest is not None and not [f for f in names if f in known]:
+            # Only new files: upload them without listing the web album
+            queueUploads(gd_client, [(os.path.join(dirname, f), webAlbum, f, None) for f in names], no_resize)
+        else:
+            # Edited or renamed files: let syncDir sort it out against the web album
+            try:
+                album = LocalAlbum(dirname, listMediaDir(dirname)[1])
+            except OSError:
+                continue
+            syncDir(gd_client, dir, album, webAlbum, no_resize, False)
+
+def watch(gd_client, source, no_resize, settle, interval, localAlbums):
+    """Upload new and changed media below source as they appear, until interrupted.
+
+    localAlbums is the MediaIndex of the initial sync; new directories are added to it.
+    """
+    changes = SettleQueue(settle)
+    if HAS_PYINOTIFY:
+        print "*** watching " + source + " (inotify)"
+        startInotifyWatch(source, changes)
+    else:
+        print "*** watching " + source + " (rescanning every " + str(interval) + " seconds)"
+        startPollingWatch(source, changes, interval)
+    skipRegex = compileSkipDirs(skipdirs)
+    try:
+        while True:
+            time.sleep(1)
+            ready = [path for path in changes.ready() if isWatchedFile(source, path, skipRegex)]
+            if ready:
+                uploadChanged(gd_client, ready, no_resize, localAlbums)
+    except KeyboardInterrupt:
+        print "*** stopped watching"
+
+##########################################################
+# Sync plans: decide everything first, upload later
+##########################################################
+
+PLAN_SCHEDULES = ['album', 'largest']
+
+def uploadSizeEstimate(media, no_resize):
+    # Bytes an upload will send: images above the free size are resized, which
+    # scales their size roughly with the number of pixels
+    dimension = None
+    if not no_resize and getContentType(media.path).startswith('image/'):
+        try:
+            dimension = imageMaxDimension(media.path, media)
+        except IOError:
+            # not readable as an image; upload() will find out
+            pass
+    if dimension and dimension > PICASA_MAX_FREE_IMAGE_DIMENSION:
+        ratio = float(PICASA_MAX_FREE_IMAGE_DIMENSION) / dimension
+        return int(media.size * ratio * ratio), True
+    return media.size, False
+
+def planUpload(dir, path, f, no_resize, replacing=None):
+    localPath = os.path.join(path, f)
+    media = describeMedia(localPath)
+    bytes, resized = uploadSizeEstimate(media, no_resize)
+    item = {'album': dir, 'path': localPath, 'file': f, 'size': media.size, 'mtime': media.mtime,
+            'bytes': bytes, 'resized': resized}
+    if replacing is not None:
+        item['replacing'] = replacing._asdict()
+    return item
+
+def buildPlan(gd_client, found, no_resize, forcemetadata):
+    """Work a sync would do, as a JSON-serializable dict; nothing is changed on the web or in the manifest.
+
+    found yields LocalAlbums like scanMedia. The plan lists the
+    albums to create, the files to upload with their original and expected
+    upload size, renames and metadata updates.
+    """
+    webAlbums = getWebAlbums(gd_client)
+    localAlbums = MediaIndex()
+    plan = {'version': 1, 'created': time.time(), 'no_resize': no_resize, 'forcemetadata': forcemetadata,
+            'albums': [], 'uploads': [], 'renames': [], 'metadata': []}
+    for album in found:
+        dir = localAlbums.add(album)
+        if dir is None:
+            continue
+        path = album.path
+        if dir not in webAlbums:
+            plan['albums'].append({'title': dir, 'path': path, 'create': True})
+            plan['uploads'].extend(planUpload(dir, path, f, no_resize) for f in album)
+            continue
+        diff = diffAlbum(gd_client, dir, localAlbums[dir], webAlbums[dir], forcemetadata)
+        if diff is None:
+            continue
+        webPhotoDict = diff['webPhotos']
+        plan['albums'].append({'title': dir, 'path': path, 'create': False})
+        for old, new in diff['renamed']:
+            plan['renames'].append({'album': dir, 'path': os.path.join(path, new), 'file': new,
+                                    'webPhoto': webPhotoDict[old]._asdict()})
+        plan['uploads'].extend(planUpload(dir, path, f, no_resize, webPhotoDict[f]) for f in diff['edited'])
+        plan['uploads'].extend(planUpload(dir, path, f, no_resize) for f in diff['localOnly'])
+        if forcemetadata:
+            plan['metadata'].extend({'album': dir, 'path': os.path.join(path, f), 'file': f,
+                                     'webPhoto': webPhotoDict[f]._asdict()} for f in diff['both'])
+    plan['totalBytes'] = sum(item['bytes'] for item in plan['uploads'])
+    return plan
+
+def writePlan(plan, path):
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=1, sort_keys=True)
+    print "*** plan written to " + path + ": " + str(len(plan['albums'])) + " album(s), " + \
+        str(len(plan['uploads'])) + " upload(s) of " + str(plan['totalBytes']) + " bytes, " + \
+        str(len(plan['renames'])) + " rename(s), " + str(len(plan['metadata'])) + " metadata update(s)"
+
+def utf8(value):
+    # json hands back unicode; the rest of the script works with UTF-8 byte strings
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [utf8(v) for v in value]
+    if isinstance(value, dict):
+        return dict((utf8(k), utf8(v)) for k, v in value.items())
+    return value
+
+def readPlan(path):
+    with open(path) as f:
+        return utf8(json.load(f))
+
+def isAlreadyUploaded(item):
+    # A replayed plan skips uploads the manifest shows as done with the same file
+    if manifest is None or not os.path.exists(item['path']):
+        return False
+    row = manifest.albumFiles(item['album']).get(item['file'])
+    st = os.stat(item['path'])
+    return row is not None and row[2] is not None and row[0] == st.st_size and row[1] == st.st_mtime
+
+def executePlan(gd_client, plan, schedule):
+    """Carry out a plan made by buildPlan.
+
+    schedule 'album' uploads album by album in plan order, 'largest' sends
+    the largest files first. Uploads already recorded in the manifest are
+    skipped, so a partly executed plan can be run again.
+    """
+    no_resize = plan['no_resize']
+    albums = {}
+    for album in plan['albums']:
+        try:
+            if album['create']:
+                albums[album['title']] = findOrCreateAlbum(gd_client, album['title'])
+            else:
+                albums[album['title']] = findAlbum(gd_client, album['title'])
+        except RETRY_EXCEPTIONS, e:
+            log("-> could not create album " + album['title'] + ": " + str(e))
+
+    uploads = [item for item in plan['uploads'] if albums.get(item['album']) is not None]
+    for rename in plan['renames']:
+        webPhoto = webPhotoFromDict(rename['webPhoto'])
+        if not renameFile(gd_client, rename['album'], rename['path'], webPhoto, rename['file']):
+            uploads.append(planUpload(rename['album'], os.path.dirname(rename['path']), rename['file'], no_resize))
+
+    if schedule == 'largest':
+        uploads.sort(key=lambda item: item['bytes'], reverse=True)
+    skipped = 0
+    todo = []
+    for item in uploads:
+        if isAlreadyUploaded(item):
+            skipped += 1
+            continue
+        replacing = None
+        if 'replacing' in item:
+            replacing = webPhotoFromDict(item['replacing'])
+        todo.append((item['path'], albums[item['album']], item['file'], replacing))
+    queueUploads(gd_client, todo, no_resize)
+    if skipped > 0:
+        log("*** " + str(skipped) + " upload(s) of the plan were already done")
+
+    updateMetadataFiles(gd_client, [(item['path'], item['file'], webPhotoFromDict(item['webPhoto']))
+        for item in plan['metadata']])
 
 # Global used for a temp directory
 gTempDir = ''
+gTempCount = 0
+gTempLock = threading.Lock()
+
+def removeTempDir():
+    if gTempDir != '':
+        shutil.rmtree(gTempDir, ignore_errors=True)
 
 def getTempPath(localPath):
     baseName = os.path.basename(localPath)
-    global gTempDir
-    if gTempDir == '':
-        gTempDir = tempfile.mkdtemp('imageshrinker')
-    tempPath = os.path.join(gTempDir, baseName)
+    global gTempDir, gTempCount
+    with gTempLock:
+        if gTempDir == '':
+            gTempDir = tempfile.mkdtemp('imageshrinker', dir=spoolDir)
+            atexit.register(removeTempDir)
+        # Prefix with a counter: parallel workers may shrink files with the same name
+        gTempCount += 1
+        tempPath = os.path.join(gTempDir, str(gTempCount) + '-' + baseName)
     return tempPath
 
-def imageMaxDimension(path):
-    if HAS_PIL_IMAGE:
-        return imageMaxDimensionByPIL(path)
-    elif HAS_SIPS:        
-        output = subprocess.check_output([sipsTool, '-g', 'pixelWidth', '-g', 'pixelHeight', path])
-        lines = output.split('\n')
-        w = int(lines[1].split()[1])
-        h = int(lines[2].split()[1])
-        return max(w,h)
-    return 0
-
-def imageMaxDimensionByPIL(path):
-  img = Image.open(path)
-  (w,h) = img.size
-  return max(w,h)
-
-def shrinkIfNeeded(path, maxDimension):
+##########################################################
+# Persistent exiftool session
+##########################################################
+
+class ExifToolSession(object):
+    """One long-running exiftool process (-stay_open) shared by all threads.
+
+    Commands are written to its argument file on stdin; the output of each
+    command ends with a "{ready}" line. This saves starting the Perl
+    interpreter for every file.
+    """
+    READY = '{ready}'
+
+    def __init__(self, executable):
+        self.executable = executable
+        self.lock = threading.Lock()
+        self.process = None
+
+    def execute(self, *args):
+        with self.lock:
+            if self.process is None:
+                self.process = subprocess.Popen([self.executable, '-stay_open', 'True', '-@', '-'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+            try:
+                self.process.stdin.write('\n'.join(args) + '\n-execute\n')
+                self.process.stdin.flush()
+                output = ''
+                while not output.rstrip().endswith(self.READY):
+                    chunk = os.read(self.process.stdout.fileno(), 65536)
+                    if not chunk:
+                        raise IOError('exiftool exited unexpectedly')
+                    output += chunk
+            except (IOError, OSError):
+                # Start a fresh process on the next call
+                self.process = None
+                raise
+        return output.rstrip()[:-len(self.READY)]
+
+    def close(self):
+        with self.lock:
+            if self.process is not None:
+                try:
+                    self.process.stdin.write('-stay_open\nFalse\n')
+                    self.process.stdin.flush()
+                    self.process.wait()
+                except (IOError, OSError):
+                    pass
+                self.process = None
+
+exifSession = None
+
+# Try to find EXIFTOOL if installed; the session is started along with it
+def hasExifTool():
+    global HAS_EXIF, exifTool, exifSession
+    with toolLock:
+        if HAS_EXIF is None:
+            exifTool = findTool('exiftool')
+            HAS_EXIF = exifTool is not None
+            if HAS_EXIF:
+                print '*** exiftool found at: ' + exifTool
+                exifSession = ExifToolSession(exifTool)
+                atexit.register(exifSession.close)
+    return HAS_EXIF
+
+def exifToolRead(paths):
+    # Returns one dict of tags per path, read in a single exiftool request
+    try:
+        output = exifSession.execute('-json', *paths)
+    except (IOError, OSError):
+        # Fall back to one exiftool run for this request
+        output = subprocess.check_output([exifTool, '-json'] + list(paths))
+    tags = {}
+    if output.strip():
+        for fileTags in json.loads(output):
+            tags[fileTags.get('SourceFile')] = fileTags
+    # Files exiftool could not read have no entry in the output
+    return [tags.get(path, {}) for path in paths]
+
+def exifToolCopyTags(source, target):
+    try:
+        exifSession.execute('-q', '-q', '-tagsfromfile', source, target)
+    except (IOError, OSError):
+        subprocess.call([exifTool, "-q", "-q", "-tagsfromfile", source, target])
+    # exiftool keeps the untagged copy as target_original; the target is our own temp file, so it can go
+    try:
+        os.remove(target + '_original')
+    except OSError:
+        pass
+
+# Tags read ahead of time in batches; key: path, value: dict of tags
+exifPrefetched = {}
+exifPrefetchedLock = threading.Lock()
+
+def prefetchExifMetadata(paths):
+    for i in range(0, len(paths), EXIFTOOL_BATCH_SIZE):
+        batch = paths[i:i + EXIFTOOL_BATCH_SIZE]
+        tags = exifToolRead(batch)
+        with exifPrefetchedLock:
+            exifPrefetched.update(zip(batch, tags))
+
+def readExifMetadata(path):
+    with exifPrefetchedLock:
+        tags = exifPrefetched.pop(path, None)
+    if tags is None:
+        tags = exifToolRead([path])[0]
+    return tags
+
+##########################################################
+# Media descriptors: what we need to know about a local file, read in one pass
+##########################################################
+
+# JPEG start-of-frame markers; 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC) share the range but are not frames
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+EXIF_TAG_DESCRIPTION = 0x010E
+EXIF_TAG_ORIENTATION = 0x0112
+
+class MediaDescriptor(object):
+    """Dimensions and metadata of a local media file.
+
+    Built once per file by describeMedia and handed through shrinkIfNeeded,
+    updatemetadata and upload, so the file header is only read once.
+    """
+    def __init__(self, path):
+        st = os.stat(path)
+        self.path = path
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        # displayed dimensions, i.e. with the EXIF orientation applied
+        self.width = None
+        self.height = None
+        self.orientation = 1
+        self.description = None
+        # fileHash() of the file, when something already had to compute it
+        self.digest = None
+        # True when the EXIF tags above were looked for, so a missing description really is missing
+        self.metadataRead = False
+
+    def maxDimension(self):
+        if self.width is None:
+            return None
+        return max(self.width, self.height)
+
+def readExifIfd(tiff, endian, offset):
+    # Returns {tag: (type, count, raw 4-byte value field)} of the IFD at offset
+    count = struct.unpack(endian + 'H', tiff[offset:offset + 2])[0]
+    tags = {}
+    for i in range(count):
+        entry = tiff[offset + 2 + i * 12:offset + 14 + i * 12]
+        tag, kind, n = struct.unpack(endian + 'HHI', entry[:8])
+        tags[tag] = (kind, n, entry[8:12])
+    return tags
+
+def exifValue(tiff, endian, tags, tag):
+    if tag not in tags:
+        return None
+    kind, n, field = tags[tag]
+    if kind == 2:
+        # ASCII; stored in place when it fits in 4 bytes
+        if n > 4:
+            offset = struct.unpack(endian + 'I', field)[0]
+            field = tiff[offset:offset + n]
+        return field[:n].rstrip('\x00').strip() or None
+    if kind == 3:
+        return struct.unpack(endian + 'H', field[:2])[0]
+    if kind == 4:
+        return struct.unpack(endian + 'I', field)[0]
+    return None
+
+def decodeText(value):
+    # Unicode, like pyexiv2 hands out; EXIF text is meant to be ASCII, but UTF-8 and Latin-1 are common
+    if not isinstance(value, str):
+        return value
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+def readExif(data, media):
+    # data is the payload of a JPEG APP1 segment; XMP packets share the marker and are ignored
+    if not data.startswith('Exif\x00\x00'):
+        return
+    tiff = data[6:]
+    if tiff[:2] == 'II':
+        endian = '<'
+    elif tiff[:2] == 'MM':
+        endian = '>'
+    else:
+        return
+    try:
+        ifd0 = readExifIfd(tiff, endian, struct.unpack(endian + 'I', tiff[4:8])[0])
+        media.orientation = exifValue(tiff, endian, ifd0, EXIF_TAG_ORIENTATION) or 1
+        description = exifValue(tiff, endian, ifd0, EXIF_TAG_DESCRIPTION)
+        if description is not None:
+            media.description = decodeText(description)
+    except struct.error:
+        pass
+
+def readJpegHeader(f, media):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            return
+        code = ord(marker[1])
+        while code == 0xff:
+            # fill bytes before the marker
+            code = ord(f.read(1) or '\x00')
+        if code == 0x01 or 0xd0 <= code <= 0xd8:
+            # markers without a length field
+            continue
+        if code in (0xd9, 0xda):
+            # end of image or start of scan before any frame header
+            return
+        length = struct.unpack('>H', f.read(2))[0]
+        if code == 0xe1:
+            readExif(f.read(length - 2), media)
+        elif code in JPEG_SOF_MARKERS:
+            h, w = struct.unpack('>xHH', f.read(5))
+            if media.orientation in (5, 6, 7, 8):
+                # rotated by 90 degrees when displayed
+                w, h = h, w
+            media.width, media.height = w, h
+            # EXIF comes before the frame header, so everything has been seen
+            media.metadataRead = True
+            return
+        else:
+            f.seek(length - 2, 1)
+
+def readMediaHeader(media):
+    try:
+        with open(media.path, 'rb') as f:
+            head = f.read(24)
+            if head.startswith('\xff\xd8'):
+                readJpegHeader(f, media)
+            elif head.startswith(PNG_SIGNATURE) and head[12:16] == 'IHDR':
+                media.width, media.height = struct.unpack('>II', head[16:24])
+    except (IOError, struct.error):
+        pass
+
+# The MEDIA_CACHE_SIZE descriptors used last, keyed by (path, size, mtime)
+mediaCache = collections.OrderedDict()
+mediaCacheLock = threading.Lock()
+
+def describeMedia(path):
+    media = MediaDescriptor(path)
+    key = (path, media.size, media.mtime)
+    with mediaCacheLock:
+        if key in mediaCache:
+            cached = mediaCache.pop(key)
+            mediaCache[key] = cached
+            return cached
+    if getContentType(path).startswith('image/'):
+        with stats.timed('probe'):
+            readMediaHeader(media)
+    with mediaCacheLock:
+        mediaCache[key] = media
+        while len(mediaCache) > MEDIA_CACHE_SIZE:
+            mediaCache.popitem(last=False)
+    return media
+
+def imageMaxDimension(path, media=None):
+    if media is None:
+        media = describeMedia(path)
+    if media.width is None:
+        # Not a format we can read the header of
+        if hasPIL():
+            img = Image.open(path)
+            (media.width, media.height) = img.size
+        elif hasSips():
+            output = subprocess.check_output([sipsTool, '-g', 'pixelWidth', '-g', 'pixelHeight', path])
+            lines = output.split('\n')
+            media.width = int(lines[1].split()[1])
+            media.height = int(lines[2].split()[1])
+        else:
+            return 0
+    return media.maxDimension()
+
+def shrinkIfNeeded(path, maxDimension, media=None):
     # Shrinking is only support if we have PIL or SIPS
-    if (HAS_PIL_IMAGE):
-        return shrinkIfNeededByPIL(path, maxDimension)
-    if HAS_SIPS:
-        if imageMaxDimension(path) > maxDimension:
-            print "-> shrinking " + path
+    if hasPIL():
+        return shrinkIfNeededByPIL(path, maxDimension, media)
+    if hasSips():
+        if imageMaxDimension(path, media) > maxDimension:
+            log("-> shrinking " + path)
             imagePath = getTempPath(path)
             subprocess.check_call([sipsTool, '--resampleHeightWidthMax', str(maxDimension), path, '--out', imagePath])
             return imagePath
     return path
 
-def shrinkIfNeededByPIL(path, maxDimension):
-    if imageMaxDimensionByPIL(path) > maxDimension:
-        print "-> shrinking " + path
-        imagePath = getTempPath(path)
-        img = Image.open(path)
-        (w,h) = img.size
-        if (w>h):
-            img2 = img.resize((maxDimension, (h*maxDimension)/w), Image.ANTIALIAS)
+def newSpool():
+    # In memory until it grows past the threshold; the file on disk is deleted when closed
+    return tempfile.SpooledTemporaryFile(max_size=spoolThreshold, dir=spoolDir)
+
+def resizeImage(path, output, maxDimension, quality, filterName):
+    # Writes the resized JPEG to the output file object; returns the size of the resized image
+    hasPIL()
+    img = Image.open(path)
+    (w,h) = img.size
+    if (w>h):
+        size = (maxDimension, (h*maxDimension)/w)
+    else:
+        size = ((w*maxDimension)/h, maxDimension)
+    # For JPEGs, let the decoder scale down by 1/2, 1/4 or 1/8 while decoding,
+    # instead of decoding the full resolution image
+    img.draft('RGB', size)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img2 = img.resize(size, getattr(Image, filterName))
+    img2.save(output, 'JPEG', quality=quality)
+    return img2.size
+
+def resizeImageData(path, maxDimension, quality, filterName):
+    # Runs in a resize worker process; the JPEG comes back through the pool's pipe
+    output = cStringIO.StringIO()
+    size = resizeImage(path, output, maxDimension, quality, filterName)
+    return size, output.getvalue()
+
+# Resizes submitted to the resize pool ahead of the upload; key: path, value: AsyncResult
+pendingResizes = {}
+pendingResizesLock = threading.Lock()
+
+def prepareResize(path, maxDimension, media=None):
+    if resizePool is None or not getContentType(path).startswith('image/'):
+        return
+    if imageMaxDimension(path, media) > maxDimension:
+        result = resizePool.apply_async(resizeImageData, (path, maxDimension, resizeQuality, resizeFilter))
+        with pendingResizesLock:
+            pendingResizes[path] = result
+
+def shrinkIfNeededByPIL(path, maxDimension, media=None):
+    # Returns the path when no resize is needed, else the resized image in a spooled temp file
+    # (or a temp file path when only exiftool can copy the EXIF data)
+    with pendingResizesLock:
+        pending = pendingResizes.pop(path, None)
+    if pending is not None or imageMaxDimension(path, media) > maxDimension:
+        log("-> shrinking " + path)
+        spool = newSpool()
+        if pending is not None:
+            size, data = pending.get()
+            spool.write(data)
+        elif resizePool is not None:
+            size, data = resizePool.apply(resizeImageData, (path, maxDimension, resizeQuality, resizeFilter))
+            spool.write(data)
         else:
-            img2 = img.resize(((w*maxDimension)/h, maxDimension), Image.ANTIALIAS)
-        img2.save(imagePath, 'JPEG', quality=99)
+            size = resizeImage(path, spool, maxDimension, resizeQuality, resizeFilter)
 
         # now copy EXIF data from original to new
-        if HAS_PYEXIV2:
-            # Method 1: use PYEXIV2
+        if hasPyexiv2():
+            # Method 1: use PYEXIV2, which edits the image in memory
             src_image = pyexiv2.ImageMetadata(path)
             src_image.read()
-            dst_image = pyexiv2.ImageMetadata(imagePath)
+            spool.seek(0)
+            dst_image = pyexiv2.ImageMetadata.from_buffer(spool.read())
             dst_image.read()
             src_image.copy(dst_image, exif=True)
             # overwrite image size based on new image
-            dst_image["Exif.Photo.PixelXDimension"] = img2.size[0]
-            dst_image["Exif.Photo.PixelYDimension"] = img2.size[1]
+            dst_image["Exif.Photo.PixelXDimension"] = size[0]
+            dst_image["Exif.Photo.PixelYDimension"] = size[1]
             dst_image.write()
-        elif HAS_EXIF:
-            # Method 2: use EXIFTOOL
-            subprocess.call([exifTool, "-q", "-q", "-tagsfromfile", path, imagePath])
-            
-        return imagePath
+            spool.seek(0)
+            spool.truncate()
+            spool.write(dst_image.buffer)
+        elif hasExifTool():
+            # Method 2: use EXIFTOOL, which only works on files
+            imagePath = getTempPath(path)
+            spool.seek(0)
+            with open(imagePath, 'wb') as f:
+                shutil.copyfileobj(spool, f)
+            spool.close()
+            exifToolCopyTags(path, imagePath)
+            return imagePath
+
+        spool.seek(0)
+        return spool
     return path
 
-def updatemetadata(gd_client, gd_photo, imagePath, fileName):
-    # Set title = 'filename' in the "photo details" view on Google Plus Albums     
-    gd_photo.title = atom.Title(text=fileName)      
-      
+def readDescription(imagePath, media=None):
     ##########################################################
     # Read EXIF/IPTC/XMP data
     ##########################################################
-    print "-> reading metadata from " + imagePath
 
-    p_summary = None
+    # Method 0: the EXIF tags were already read with the file header
+    if media is not None and media.metadataRead:
+        return media.description
+
+    log("-> reading metadata from " + imagePath)
+    description = None
     
     # Method 1: use PYEXIV2, preferred method
-    if HAS_PYEXIV2:
+    if hasPyexiv2():
         p_metadata = pyexiv2.ImageMetadata(imagePath)
         p_metadata.read()
         # Retrieve DESCRIPTION
         if 'Exif.Image.ImageDescription' in p_metadata.exif_keys:
-            p_summary = atom.Summary(text=p_metadata['Exif.Image.ImageDescription'].value, summary_type='text')
+            description = p_metadata['Exif.Image.ImageDescription'].value
     
     # Method 2: use EXIFTOOL
-    if ((p_summary is None) and HAS_EXIF):
-        # Call ExifTool on the file to read all tags...
-        exifdata = subprocess.check_output([exifTool, imagePath])
-        exifdata = exifdata.splitlines()
-        p_metadata = dict()
-        for i, each in enumerate(exifdata):
-            # tags and values are separated by a colon
-            tag,val = each.split(': ', 1) # '1' only allows one split
-            p_metadata[tag.strip()] = val.strip()
+    if ((description is None) and hasExifTool()):
+        # Ask the exiftool session for all tags of the file...
+        p_metadata = readExifMetadata(imagePath)
         
-        # Now we have all tags we need in exif.keys()
-        if 'Image Description' in p_metadata.keys():
-            p_summary = atom.Summary(text=p_metadata['Image Description'], summary_type='text')
-    
-    # Add result to the to-be written picture...   
-    if (p_summary is not None):              
-        gd_photo.summary = p_summary
+        # Now we have all tags we need in p_metadata.keys()
+        if 'ImageDescription' in p_metadata.keys():
+            description = unicode(p_metadata['ImageDescription']).encode('utf-8')
+
+    return description
+
+def updatemetadata(gd_client, gd_photo, imagePath, fileName, media=None):
+    # Set title = 'filename' in the "photo details" view on Google Plus Albums     
+    gd_photo.title = atom.Title(text=fileName)      
+
+    # Add the description to the to-be written picture...   
+    description = readDescription(imagePath, media)
+    if (description is not None):              
+        gd_photo.summary = atom.Summary(text=description, summary_type='text')
     
     return gd_photo
 
-def upload(gd_client, localPath, album, fileName, no_resize):
-    print "Processing " + localPath
+def insertPhotoData(gd_client, album, photo, data, size, fileName, contentType):
+    # InsertPhoto for an open file: the data is streamed from it instead of copied first
+    data.seek(0)
+    mediasource = gdata.MediaSource(data, contentType, content_length=size, file_name=fileName)
+    try:
+        return gd_client.Post(photo, uri=album.GetFeedLink().href, media_source=mediasource,
+            converter=gdata.photos.PhotoEntryFromString)
+    except gdata.service.RequestError, e:
+        raise GooglePhotosException(e.args[0])
+
+def updatePhotoData(gd_client, gd_photo, data, size, fileName, contentType):
+    # UpdatePhotoBlob for an open file
+    data.seek(0)
+    photoblob = gdata.MediaSource(data, contentType, content_length=size, file_name=fileName)
+    try:
+        return gd_client.Put(photoblob, gd_photo.GetEditMediaLink().href,
+            converter=gdata.photos.PhotoEntryFromString)
+    except gdata.service.RequestError, e:
+        raise GooglePhotosException(e.args[0])
+
+def journal(album, fileName, state, photoId=None, session=None):
+    if manifest is not None:
+        manifest.journal(album.title.text, fileName, state, photoId, session)
+
+def upload(gd_client, localPath, album, fileName, no_resize, media=None, replacing=None):
+    # replacing is the WebPhoto of an older version of the file, whose content is replaced
+    log("Processing " + localPath)
     contentType = getContentType(fileName)
+    if media is None:
+        media = describeMedia(localPath)
 
     ##########################################################
     # Do sanity check: picture to be resized? Video file within limits?
     ##########################################################
+    imageData = None
     if contentType.startswith('image/'):
         if no_resize:
             imagePath = localPath
         else:
-            imagePath = shrinkIfNeeded(localPath, PICASA_MAX_FREE_IMAGE_DIMENSION)
+            started = time.time()
+            imagePath = shrinkIfNeeded(localPath, PICASA_MAX_FREE_IMAGE_DIMENSION, media)
+            if not isinstance(imagePath, basestring):
+                # Resized into a spooled temp file; the metadata is still read from the original
+                imageData = imagePath
+                imagePath = localPath
+                imageData.seek(0, os.SEEK_END)
+                stats.record('resize', time.time() - started, media.size, imageData.tell())
+            elif imagePath != localPath:
+                stats.record('resize', time.time() - started, media.size, os.path.getsize(imagePath))
+            if imagePath != localPath or imageData is not None:
+                journal(album, fileName, 'resized')
 
         isImage = True
         picasa_photo = gdata.photos.PhotoEntry()
     else:
-        size = os.path.getsize(localPath)
+        size = media.size
 
         # tested by cpbotha on 2013-05-24 / tested by crisp on 2015-02-24
         # this limit still exists
         if size > PICASA_MAX_VIDEO_SIZE_BYTES:
-            print "-> Video file too big to upload: " + str(size) + " > " + str(PICASA_MAX_VIDEO_SIZE_BYTES)
+            log("-> Video file too big to upload: " + str(size) + " > " + str(PICASA_MAX_VIDEO_SIZE_BYTES))
             return
         imagePath = localPath
         isImage = False
@@ -559,31 +3014,73 @@ def upload(gd_client, localPath, album, fileName, no_resize):
     ##########################################################
     # Update metadata
     ##########################################################
-    picasa_photo = updatemetadata(gd_client, picasa_photo, imagePath, fileName)
+    with stats.timed('metadata'):
+        picasa_photo = updatemetadata(gd_client, picasa_photo, imagePath, fileName, media)
           
     ##########################################################
     # Upload picture
     ##########################################################
 
-    print '-> uploading ' + imagePath
-    delay = 1
-    while True:
+    resumable = None
+    if imageData is not None:
+        log('-> uploading resized ' + imagePath)
+        imageData.seek(0, os.SEEK_END)
+        imageSize = imageData.tell()
+    else:
+        log('-> uploading ' + imagePath)
+        imageSize = os.path.getsize(imagePath)
+        if not isImage or imageSize > RESUMABLE_UPLOAD_THRESHOLD:
+            # Stream from disk in chunks; a retry continues where the last attempt stopped,
+            # and a run after an interruption continues the session the journal has
+            session = None
+            if manifest is not None:
+                session = manifest.journalSession(album.title.text, fileName)
+            resumable = ResumableUpload(gd_client, album, picasa_photo, imagePath, contentType, location=session,
+                onSession=lambda location: journal(album, fileName, 'uploading', session=location),
+                findEntry=lambda: findWebPhotoEntry(gd_client, album, fileName))
+    def insert():
+        if replacing is not None and isImage:
+            # Swap the image data; the web photo keeps its id, comments and metadata
+            if imageData is not None:
+                return updatePhotoData(gd_client, getWebPhotoEntry(gd_client, replacing), imageData, imageSize, fileName, contentType)
+            return gd_client.UpdatePhotoBlob(getWebPhotoEntry(gd_client, replacing), imagePath, content_type=contentType)
+        if resumable is not None:
+            return resumable.run()
         try:
-            if isImage:
-                photo = gd_client.InsertPhoto(album, picasa_photo, imagePath, content_type=contentType)
-            else:
-                video = gd_client.InsertVideo(album, picasa_photo, imagePath, content_type=contentType)
-            break
-        except gdata.photos.service.GooglePhotosException, e:
-          print "Got exception " + str(e)
-          print "retrying in " + str(delay) + " seconds"
-          time.sleep(delay)
-          delay = delay * 2
+            if imageData is not None:
+                return insertPhotoData(gd_client, album, picasa_photo, imageData, imageSize, fileName, contentType)
+            return gd_client.InsertPhoto(album, picasa_photo, imagePath, content_type=contentType)
+        except RETRY_EXCEPTIONS, e:
+            return recoverPost(e, fileName, lambda: findWebPhotoEntry(gd_client, album, fileName))
+    try:
+        if replacing is not None and not isImage:
+            # The blob of a video cannot be swapped: remove the old one and upload again
+            retryPolicy.call(gd_client.Delete, replacing.editLink)
+            replacing = None
+        journal(album, fileName, 'uploading')
+        with stats.timed('upload') as timer:
+            timer.bytesIn = media.size
+            timer.bytesOut = imageSize
+            entry = retryPolicy.call(insert)
+        if resumable is not None and media.digest is None:
+            media.digest = resumable.digest()
+    except RETRY_EXCEPTIONS, e:
+        entry = None
+        deadLetter(localPath, upload, (localPath, album, fileName, no_resize, media, replacing), e)
 
     # delete the temp file that was created if we shrank an image:
-    if imagePath != localPath:
+    if imageData is not None:
+        imageData.close()
+    elif imagePath != localPath:
         os.remove(imagePath)
 
+    if entry is None:
+        return
+
+    if manifest is not None:
+        manifest.record(album.title.text, fileName, localPath, photoIdOf(entry), media.digest)
+    journal(album, fileName, 'done', photoIdOf(entry))
+
     ##########################################################
     # Post-processing of tags
     ########################################################## 
@@ -601,22 +3098,76 @@ def upload(gd_client, localPath, album, fileName, no_resize):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Upload pictures to picasa web albums / Google+.')
     parser.add_argument('--email', help='the google account email to use (example@gmail.com)', required=True)
-    parser.add_argument('--password', help='the password (you will be prompted if this is omitted)', required=False)
+    parser.add_argument('--password', help='the password (taken from $' + PASSWORD_ENVIRONMENT + ', or you will be prompted, if this is omitted)', required=False)
+    parser.add_argument('--server', help='base URL of the service, e.g. of a local stand-in for testing (default: ' + PICASA_SERVER + ')', default=PICASA_SERVER)
     parser.add_argument('--source', help='the directory to upload', required=True)
     parser.add_argument('--no-resize', help="Do not resize images, i.e., upload photos with original size.", action='store_true')
     parser.add_argument('--skipdirs', help='a vertical slash "|" separated list of directory regex patterns to skip', required=False)
+    parser.add_argument('--scan-threads', help='number of threads scanning the source directory (default: ' + str(SCAN_THREADS) + ')', type=int, default=SCAN_THREADS)
+    parser.add_argument('--skip-duplicates', help='report byte-identical files and directories, and upload only one copy of each file', action='store_true')
+    parser.add_argument('--watch', help='after the initial sync, keep running and upload new or changed files as they appear', action='store_true')
+    parser.add_argument('--watch-settle', help='seconds a file must stay unchanged before it is uploaded in watch mode (default: ' + str(WATCH_SETTLE_SECONDS) + ')', type=float, default=WATCH_SETTLE_SECONDS)
+    parser.add_argument('--watch-poll-interval', help='seconds between rescans in watch mode when pyinotify is not installed (default: ' + str(WATCH_POLL_INTERVAL) + ')', type=int, default=WATCH_POLL_INTERVAL)
+    parser.add_argument('--plan', help='do not upload anything; write the work a sync would do to this JSON file', required=False)
+    parser.add_argument('--execute-plan', help='carry out a plan written with --plan instead of scanning --source', required=False)
+    parser.add_argument('--schedule', help='upload order when executing a plan: album by album, or largest files first (default: album)', choices=PLAN_SCHEDULES, default='album')
     parser.add_argument('--forcemetadata', help='force remote updating of metadata for all pictures', action='store_true')
+    parser.add_argument('--metadata-jobs', help='number of metadata updates sent in parallel with --forcemetadata (default: 4)', type=int, default=4)
+    parser.add_argument('--resize-quality', help='JPEG quality of resized images (default: 99)', type=int, default=99)
+    parser.add_argument('--resize-filter', help='resampling filter used to resize images (default: ANTIALIAS)', choices=RESIZE_FILTERS, default='ANTIALIAS')
+    parser.add_argument('--spool-dir', help='directory for resized images too large to keep in memory, e.g. a tmpfs such as /dev/shm (default: system temp directory)', required=False)
+    parser.add_argument('--spool-threshold', help='size in bytes above which a resized image is spooled to disk (default: ' + str(SPOOL_THRESHOLD) + ')', type=int, default=SPOOL_THRESHOLD)
+    parser.add_argument('--resize-workers', help='number of processes resizing images (default: number of cores)', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--retry-attempts', help='attempts per upload before giving up (default: ' + str(RETRY_MAX_ATTEMPTS) + ')', type=int, default=RETRY_MAX_ATTEMPTS)
+    parser.add_argument('--max-requests-per-second', help='request budget for the service, 0 for no limit (default: no limit; throttling is left to the concurrency limit)', type=float, default=RATE_LIMIT_REQUESTS_PER_SECOND)
+    parser.add_argument('--max-bytes-per-second', help='upload bandwidth budget, 0 for no limit (default: no limit)', type=int, default=RATE_LIMIT_BYTES_PER_SECOND)
+    parser.add_argument('--budget-file', help='JSON file with the upload bandwidth budget ({"bytesPerSecond": N}), read again while running; overrides --max-bytes-per-second once present. The bandwidth used is written to the same path plus .usage', required=False)
+    parser.add_argument('--retry-max-delay', help='longest wait between two attempts, in seconds (default: ' + str(RETRY_MAX_DELAY) + ')', type=int, default=RETRY_MAX_DELAY)
+    parser.add_argument('--report', help='write a run report with timings per stage to this file', required=False)
+    parser.add_argument('--report-format', help='format of the run report (default: json)', choices=REPORT_FORMATS, default='json')
+    parser.add_argument('--manifest', help='sqlite file recording uploaded files (default: ' + DEFAULT_MANIFEST_PATH + ')', default=DEFAULT_MANIFEST_PATH)
+    parser.add_argument('--no-manifest', help='do not use the manifest; list every web album', action='store_true')
+    parser.add_argument('--check', help='exit without logging in when the manifest shows no local changes, e.g. for runs from cron', action='store_true')
+    parser.add_argument('--jobs', help='number of files to resize and upload in parallel (default: 1)', type=int, default=1)
 
     args = parser.parse_args()
 
+    if 'skipdirs' in args and args.skipdirs is not None:
+        # Get a list of all the regex's of directories to skip; we use "|" as separation character
+        skipdirs = args.skipdirs.split("|")
+        for regex in skipdirs:
+           print '*** skipping directories: ' + regex 
+
+    if not args.no_manifest:
+        manifest = Manifest(args.manifest)
+        unfinished = manifest.unfinishedFiles()
+        if unfinished > 0:
+            print "*** resuming an interrupted run: " + str(unfinished) + " file(s) were not finished"
+
+    found = None
+    if args.check and manifest is not None and unfinished == 0 and not (args.plan or args.execute_plan or args.forcemetadata or args.watch):
+        # Scan the source before anything else; when the manifest knows every file as it is,
+        # there is nothing to upload and no need to log in
+        found = list(discoverMedia(args.source, args.skip_duplicates, args.scan_threads))
+        checked = MediaIndex()
+        clean = True
+        for album in found:
+            dir = checked.add(album)
+            if dir is not None and not manifest.isAlbumClean(dir, album):
+                clean = False
+                break
+        if clean:
+            manifest.close()
+            print "*** nothing to do, the manifest is up to date with " + args.source
+            sys.exit(0)
+
     if args.no_resize:
         print "*** Images will be uploaded at original size."
     else:
-        if (HAS_PIL_IMAGE or HAS_SIPS):
-            if HAS_PIL_IMAGE:
-                print "*** Images will be resized to 2048 pixels (PIL)."
-            if HAS_SIPS:
-                print "*** Images will be resized to 2048 pixels (SIPS)."
+        if hasPIL():
+            print "*** Images will be resized to 2048 pixels (PIL)."
+        elif hasSips():
+            print "*** Images will be resized to 2048 pixels (SIPS)."
         else:
             print "*** WARNING: resize requested but neither PIL or SIPS has been found! Images will not be resized."
             
@@ -624,34 +3175,97 @@ if __name__ == '__main__':
     password = None
     if 'password' in args and args.password is not None:
         password = args.password
+    elif os.environ.get(PASSWORD_ENVIRONMENT):
+        password = os.environ[PASSWORD_ENVIRONMENT]
     else:
         password = getpass.getpass("Enter password for " + email + ": ")
 
-    if 'skipdirs' in args and args.skipdirs is not None:
-        # Get a list of all the regex's of directories to skip; we use "|" as separation character
-        skipdirs = args.skipdirs.split("|")
-        for regex in skipdirs:
-           print '*** skipping directories: ' + regex 
-
     print ''
     
+    picasaServer = args.server.rstrip('/')
+    retryPolicy = RetryPolicy(maxAttempts=args.retry_attempts, maxDelay=args.retry_max_delay)
+    # At most one request per client in flight; throttling brings the limit down from there
+    clients = 1 + (args.jobs if args.jobs > 1 else 0) + (args.metadata_jobs if args.forcemetadata and args.metadata_jobs > 1 else 0)
+    rateLimiter = RateLimiter(args.max_requests_per_second, args.max_bytes_per_second, clients, args.budget_file)
+    resizeQuality = args.resize_quality
+    resizeFilter = args.resize_filter
+    spoolDir = args.spool_dir
+    spoolThreshold = args.spool_threshold
+    if hasPIL() and not args.no_resize and args.resize_workers > 0:
+        # Start the resize processes before any threads exist
+        resizePool = multiprocessing.Pool(args.resize_workers)
+        resizeWorkers = args.resize_workers
+
     gd_client = login(email, password)
+    if args.jobs > 1:
+        print '*** uploading with ' + str(args.jobs) + ' parallel workers'
+        uploadPool = UploadPool(args.jobs, lambda: login(email, password))
+    if args.forcemetadata and args.metadata_jobs > 1:
+        # Its clients log in once a web photo turns out to need an update
+        metadataPool = UploadPool(args.metadata_jobs, lambda: login(email, password), 'update metadata', lazy=True)
     # protectWebAlbums(gd_client)
     
     # Retrieve web albums, index local albums 
     # -> Results of retrieval functions are mappings between picture path & album they correspond to
     webAlbums = getWebAlbums(gd_client)
-    localAlbums = toBaseName(findMedia(args.source))
-    
-    # Compare albums found locally with those on the web. This will not compare individual
-    # pictures but just whether the album exists or not
-    albumDiff = compareLocalToWeb(localAlbums, webAlbums)
-    
-    # Synchronize files in albums that exist both locally & on the web
-    syncDirs(gd_client, albumDiff['both'], localAlbums, webAlbums, args.no_resize, args.forcemetadata)
-    
-    # Upload (entire) albums that exist only locally
-    uploadDirs(gd_client, albumDiff['localOnly'], localAlbums, args.no_resize)
+    localAlbums = MediaIndex()
+
+    if args.execute_plan:
+        # Carry out a plan made earlier; the source is not scanned again
+        executePlan(gd_client, readPlan(args.execute_plan), args.schedule)
+    elif args.plan:
+        # Dry run: only write down what would be done
+        found = discoverMedia(args.source, args.skip_duplicates, args.scan_threads)
+        writePlan(buildPlan(gd_client, found, args.no_resize, args.forcemetadata), args.plan)
+    else:
+        # Handle the local albums in path order. This will not compare
+        # individual pictures but just whether the album exists on the web or not
+        if found is None:
+            found = discoverMedia(args.source, args.skip_duplicates, args.scan_threads)
+        dirs = [dir for dir in [localAlbums.add(album) for album in found] if dir is not None]
+        if manifest is not None:
+            # Before any album forgets the rows of its vanished files: they may have moved to another one
+            vanishedFiles = VanishedFiles(manifest.vanishedFiles(localAlbums))
+        for dir in dirs:
+            if dir in webAlbums:
+                # Synchronize files in albums that exist both locally & on the web
+                syncDir(gd_client, dir, localAlbums[dir], webAlbums[dir], args.no_resize, args.forcemetadata)
+            else:
+                # Upload (entire) albums that exist only locally
+                uploadDir(gd_client, dir, localAlbums[dir], args.no_resize)
+        vanishedFiles = None
+
+        # Keep going with whatever lands in the source directory from now on
+        if args.watch:
+            watch(gd_client, args.source, args.no_resize, args.watch_settle, args.watch_poll_interval, localAlbums)
+
+    # Wait for the workers to drain the upload queue
+    if uploadPool is not None:
+        uploadPool.join()
+        uploadPool = None
+    if metadataPool is not None:
+        metadataPool.join()
+        metadataPool = None
+    if metadataSkipped > 0:
+        print "*** " + str(metadataSkipped) + " metadata update(s) skipped, the web photos were up to date"
+
+    # One more sequential pass over whatever failed
+    retryDeadLetters(gd_client)
+    rateLimiter.report()
+    connectionPool.report()
+    connectionPool.close()
+
+    if args.report:
+        stats.write(args.report, args.report_format)
+        print "*** run report written to " + args.report
+
+    if resizePool is not None:
+        resizePool.close()
+        resizePool.join()
+
+    if manifest is not None:
+        manifest.clearJournal()
+        manifest.close()
 
     print "*** execution finished."
     
\ No newline at end of file
@@ -0,0 +1,392 @@
+#! /usr/bin/python
+#
+# Runs main.py for several (account, source) jobs in one scheduled window
+#
+# Jobs come from a JSON config. They are sharded by account, so two runs of
+# the same account never create albums at the same time, and the shards run
+# in parallel worker processes. Every job has a manifest of its own. The
+# workers share one upload bandwidth budget, split among the running jobs by
+# what they use and handed over through budget files main.py reads again
+# while it runs, and the cores of the machine for resizing. Each job writes a
+# run report; they are combined into one report for the whole window.
+#
+# Config:
+#   {"jobs": [
+#       {"email": "me@gmail.com", "source": "/photos/family", "skipdirs": "tmp|@eaDir"},
+#       {"email": "me@gmail.com", "source": "/photos/travel"},
+#       {"email": "club@gmail.com", "source": "/photos/club", "password": "...", "args": ["--jobs", "4"]}
+#   ]}
+#
+# Usage:
+#   python runner.py --config jobs.json [--workers N] [--max-bytes-per-second N] [-- extra main.py arguments]
+#
+
+import argparse
+import getpass
+import hashlib
+import json
+import multiprocessing
+import os
+import Queue
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import main
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+CONFIG_DIR = os.path.dirname(main.DEFAULT_MANIFEST_PATH)
+DEFAULT_LOG_DIR = os.path.join(CONFIG_DIR, 'runner')
+# Seconds between two splits of the bandwidth among the running jobs
+REBALANCE_INTERVAL = 5
+# A job sending at least this fraction of its share could use more
+BUSY_FRACTION = 0.8
+# Share of a job that uses little, as a fraction of an even share, and over what it uses
+IDLE_FRACTION = 0.25
+IDLE_HEADROOM = 2
+
+printLock = threading.Lock()
+
+def say(message):
+    with printLock:
+        print message
+        sys.stdout.flush()
+
+##########################################################
+# Jobs
+##########################################################
+
+def readConfig(path):
+    with open(path) as f:
+        config = json.load(f)
+    jobs = config.get('jobs', []) if isinstance(config, dict) else []
+    for i, job in enumerate(jobs):
+        if 'email' not in job or 'source' not in job:
+            sys.exit("*** job " + str(i + 1) + " of " + path + " needs an email and a source")
+        job['index'] = i + 1
+    if not jobs:
+        sys.exit("*** no jobs in " + path)
+    return jobs
+
+def shardJobs(jobs):
+    # One shard per account, jobs in config order; the longest shards go first
+    shards = []
+    byEmail = {}
+    for job in jobs:
+        if job['email'] not in byEmail:
+            byEmail[job['email']] = []
+            shards.append(byEmail[job['email']])
+        byEmail[job['email']].append(job)
+    return sorted(shards, key=len, reverse=True)
+
+def manifestPath(job):
+    # One manifest per account and source: two sources of an account may hold directories of the
+    # same name, and a shared manifest would have each job forget the rows of the other
+    if job.get('manifest'):
+        return job['manifest']
+    source = os.path.abspath(job['source'])
+    return os.path.join(CONFIG_DIR, 'manifest-' + re.sub(r'[^\w.@-]', '_', job['email'] + '-' + os.path.basename(source))
+                        + '-' + hashlib.sha1(source).hexdigest()[:8] + '.sqlite')
+
+def jobName(job):
+    return str(job['index']) + '-' + re.sub(r'[^\w.@-]', '_', job['email'] + '-' + os.path.basename(job['source'].rstrip('/\\')))
+
+def askPasswords(jobs):
+    # Asked once per account up front; the workers get it through the environment
+    passwords = {}
+    for job in jobs:
+        if job.get('password'):
+            passwords.setdefault(job['email'], job['password'])
+    for job in jobs:
+        if job['email'] not in passwords:
+            passwords[job['email']] = getpass.getpass("Enter password for " + job['email'] + ": ")
+    return passwords
+
+##########################################################
+# Shared budget
+##########################################################
+
+def splitBandwidth(total, demands):
+    """Max-min fair split of total bytes per second among jobs.
+
+    demands maps each job to the bytes per second it can use, or None when
+    it would use whatever it gets. Jobs wanting less than an even share get
+    what they want, the rest is split evenly among the others, and what
+    nobody wants is spread over all jobs.
+    """
+    shares = {}
+    left = float(total)
+    order = sorted(demands, key=lambda name: (demands[name] is None, demands[name]))
+    for i, name in enumerate(order):
+        fair = left / (len(order) - i)
+        shares[name] = fair if demands[name] is None else min(fair, demands[name])
+        left -= shares[name]
+    return dict((name, max(1, int(share + left / len(shares)))) for name, share in shares.items())
+
+class Budget(object):
+    """Upload bandwidth and cores shared by the jobs of the runner.
+
+    main.py writes the bandwidth it uses next to its budget file. Every
+    REBALANCE_INTERVAL seconds, and whenever a job starts or ends, the
+    bandwidth is split again: a job using less than BUSY_FRACTION of its
+    share (still scanning, or done uploading) keeps a little more than it
+    uses, and the rest goes to the jobs using all they get. A job that has
+    not reported yet counts as busy. The shares are written to the budget
+    files and main.py picks them up within a second. Resize processes can
+    not be added to a running job, so the cores are split among the workers
+    when a job starts.
+    """
+    def __init__(self, bytesPerSecond, cores, workers, dir):
+        self.bytesPerSecond = bytesPerSecond
+        self.cores = cores
+        self.workers = workers
+        self.dir = dir
+        self.lock = threading.Lock()
+        self.running = {}
+        self.shares = {}
+        self.stopped = threading.Event()
+        if bytesPerSecond > 0:
+            rebalancer = threading.Thread(target=self.rebalanceOften)
+            rebalancer.daemon = True
+            rebalancer.start()
+
+    def start(self, name):
+        # Returns the budget file of the job (None without a bandwidth budget) and its resize processes
+        path = None
+        with self.lock:
+            if self.bytesPerSecond > 0:
+                path = os.path.join(self.dir, name + '.budget')
+                self.running[name] = path
+                self.rebalance()
+        return path, max(1, self.cores // self.workers)
+
+    def finish(self, name):
+        with self.lock:
+            path = self.running.pop(name, None)
+            self.shares.pop(name, None)
+            if path is not None:
+                self.rebalance()
+                for stale in [path, path + '.usage']:
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass
+
+    def close(self):
+        self.stopped.set()
+
+    def rebalanceOften(self):
+        while not self.stopped.wait(REBALANCE_INTERVAL):
+            with self.lock:
+                self.rebalance()
+
+    def usage(self, path):
+        # Bytes per second the job reported, 0 when it has not sent anything for a while, None before its first report
+        if not os.path.exists(path + '.usage'):
+            return None
+        try:
+            if time.time() - os.path.getmtime(path + '.usage') > 2 * REBALANCE_INTERVAL:
+                return 0
+            with open(path + '.usage') as f:
+                return json.load(f)['bytesPerSecond']
+        except (IOError, OSError, ValueError, KeyError):
+            return 0
+
+    def rebalance(self):
+        if not self.running:
+            return
+        evenShare = self.bytesPerSecond / float(len(self.running))
+        demands = {}
+        for name, path in self.running.items():
+            used = self.usage(path)
+            if used is None or used >= BUSY_FRACTION * self.shares.get(name, evenShare):
+                demands[name] = None
+            else:
+                demands[name] = max(used * IDLE_HEADROOM, evenShare * IDLE_FRACTION)
+        for name, share in splitBandwidth(self.bytesPerSecond, demands).items():
+            if share == self.shares.get(name):
+                continue
+            self.shares[name] = share
+            path = self.running[name]
+            # Written next to the target and renamed, so main.py never reads half a file
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'bytesPerSecond': share}, f)
+            os.rename(path + '.tmp', path)
+
+##########################################################
+# Workers
+##########################################################
+
+def exitCode(status):
+    # Exit code of a wait() status the way subprocess reports it: negative for the signal that ended the process
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def runJob(job, budget, logDir, password, extraArgs):
+    name = jobName(job)
+    logPath = os.path.join(logDir, name + '.log')
+    reportPath = os.path.join(logDir, name + '.json')
+    if os.path.exists(reportPath):
+        os.remove(reportPath)
+    budgetPath, resizeWorkers = budget.start(name)
+    command = [sys.executable, MAIN_PATH, '--email', job['email'], '--source', job['source'],
+               '--manifest', manifestPath(job), '--report', reportPath, '--resize-workers', str(resizeWorkers)]
+    if job.get('skipdirs'):
+        skipdirs = job['skipdirs']
+        command += ['--skipdirs', skipdirs if isinstance(skipdirs, basestring) else '|'.join(skipdirs)]
+    if budgetPath is not None:
+        command += ['--budget-file', budgetPath]
+    # Arguments of the job come last, so they win over the ones of the runner
+    command += extraArgs + job.get('args', [])
+    env = dict(os.environ)
+    env[main.PASSWORD_ENVIRONMENT] = password
+
+    say("*** job " + str(job['index']) + " started: " + job['email'] + " " + job['source'])
+    started = time.time()
+    usage = None
+    try:
+        with open(logPath, 'w') as log:
+            child = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+            if hasattr(os, 'wait4'):
+                pid, status, usage = os.wait4(child.pid, 0)
+                status = child.returncode = exitCode(status)
+            else:
+                status = child.wait()
+    finally:
+        budget.finish(name)
+    wall = time.time() - started
+
+    result = {'job': job['index'], 'email': job['email'], 'source': job['source'], 'exitStatus': status,
+              'wall': wall, 'log': logPath, 'report': None}
+    if usage is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+        result['cpu'] = usage.ru_utime + usage.ru_stime
+        result['peakRss'] = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    try:
+        with open(reportPath) as f:
+            result['report'] = json.load(f)
+    except (IOError, ValueError):
+        pass
+    if status != 0:
+        say("*** job " + str(job['index']) + " failed, see " + logPath)
+    else:
+        say("*** job " + str(job['index']) + " finished in " + str(int(wall)) + "s")
+    return result
+
+def runShards(shards, workers, budget, logDir, passwords, extraArgs):
+    # Each worker thread takes one shard at a time and runs its jobs one after the other
+    todo = Queue.Queue()
+    for shard in shards:
+        todo.put(shard)
+    results = []
+    resultsLock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                shard = todo.get_nowait()
+            except Queue.Empty:
+                return
+            for job in shard:
+                result = runJob(job, budget, logDir, passwords[job['email']], extraArgs)
+                with resultsLock:
+                    results.append(result)
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # Join with a timeout, so Ctrl-C still reaches the main thread
+        while t.is_alive():
+            t.join(1)
+    return sorted(results, key=lambda r: r['job'])
+
+##########################################################
+# Combined report
+##########################################################
+
+def combineReports(results, elapsed):
+    """One report in the format of main.py --report, for all jobs together.
+
+    Counts, seconds and bytes are summed over the jobs. The quantiles of a
+    stage are the highest of the jobs, as the samples themselves are not in
+    the reports. The reports of the jobs are kept under 'jobs'.
+    """
+    files = 0
+    uploaded = 0
+    counters = {}
+    stages = {}
+    for result in results:
+        report = result['report']
+        if report is None:
+            continue
+        files += report['files']
+        uploaded += report['bytes']
+        for event, n in report['counters'].items():
+            counters[event] = counters.get(event, 0) + n
+        for stage, s in report['stages'].items():
+            combined = stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max': 0.0, 'bytesIn': 0, 'bytesOut': 0})
+            for key in ['count', 'seconds', 'bytesIn', 'bytesOut']:
+                combined[key] += s[key]
+            for key in ['max'] + ['p' + str(int(q * 100)) for q in main.REPORT_QUANTILES]:
+                combined[key] = max(combined.get(key, 0.0), s[key])
+    return {'elapsed': elapsed, 'files': files, 'bytes': uploaded,
+            'filesPerSecond': files / elapsed if elapsed > 0 else 0.0,
+            'megabytesPerSecond': uploaded / 1048576.0 / elapsed if elapsed > 0 else 0.0,
+            'counters': counters, 'stages': stages,
+            'failedJobs': len([r for r in results if r['exitStatus'] != 0]),
+            'jobs': results}
+
+def printResults(results):
+    print ''
+    print '%-4s %-30s %-30s %10s %10s %8s  %s' % ('job', 'account', 'source', 'wall (s)', 'cpu (s)', 'files', 'status')
+    for r in results:
+        files = r['report']['files'] if r['report'] is not None else 0
+        print '%-4d %-30s %-30s %10.1f %10.1f %8d  %s' % (r['job'], r['email'][:30], r['source'][-30:], r['wall'],
+            r.get('cpu', 0.0), files, 'ok' if r['exitStatus'] == 0 else 'failed')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run main.py for every job of a config, sharded by account over parallel workers; '
+                                     'arguments after "--" are passed on to every main.py')
+    parser.add_argument('--config', help='JSON file with the jobs: {"jobs": [{"email": ..., "source": ..., "skipdirs": ...}, ...]}', required=True)
+    parser.add_argument('--workers', help='accounts synchronized at the same time (default: all of them)', type=int, required=False)
+    parser.add_argument('--max-bytes-per-second', help='upload bandwidth shared by all jobs, 0 for no limit (default: no limit)', type=int, default=0)
+    parser.add_argument('--cores', help='cores shared by the resize processes of the jobs (default: ' + str(multiprocessing.cpu_count()) + ')', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--log-dir', help='directory for the logs and reports of the jobs (default: ' + DEFAULT_LOG_DIR + ')', default=DEFAULT_LOG_DIR)
+    parser.add_argument('--report', help='write the combined run report (JSON) to this file', required=False)
+
+    argv = sys.argv[1:]
+    extraArgs = []
+    if '--' in argv:
+        extraArgs = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    jobs = readConfig(args.config)
+    shards = shardJobs(jobs)
+    workers = max(1, min(args.workers or len(shards), len(shards)))
+    passwords = askPasswords(jobs)
+    if not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    print "*** " + str(len(jobs)) + " job(s) for " + str(len(shards)) + " account(s), " + str(workers) + " at a time"
+    budget = Budget(args.max_bytes_per_second, args.cores, workers, args.log_dir)
+    started = time.time()
+    results = runShards(shards, workers, budget, args.log_dir, passwords, extraArgs)
+    budget.close()
+    report = combineReports(results, time.time() - started)
+    printResults(results)
+
+    if args.report:
+        tempPath = args.report + '.tmp'
+        with open(tempPath, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        os.rename(tempPath, args.report)
+        print "*** combined run report written to " + args.report
+
+    print "*** " + str(report['files']) + " file(s) uploaded by " + str(len(results)) + " job(s), " + str(report['failedJobs']) + " failed"
+    sys.exit(1 if report['failedJobs'] > 0 else 0)
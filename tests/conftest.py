@@ -0,0 +1,26 @@
+# Fixtures running main.py code against the fake service of benchmark.py
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import main
+
+@pytest.fixture
+def service():
+    service = benchmark.FakePicasa()
+    server = benchmark.startServer(service)
+    yield service
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client(service, monkeypatch):
+    # A logged in client of the fake service, without a request budget
+    monkeypatch.setattr(main, 'picasaServer', service.base)
+    monkeypatch.setattr(main, 'rateLimiter', main.RateLimiter())
+    return main.login(benchmark.USER, 'secret')
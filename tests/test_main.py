@@ -0,0 +1,213 @@
+# main.py runs against the fake service: retries, throttling and resumed uploads
+
+import json
+import multiprocessing
+import os
+import sqlite3
+import struct
+import subprocess
+import sys
+import time
+
+import pytest
+from PIL import Image
+
+import benchmark
+import main
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+# A video of two resumable upload chunks
+VIDEO_SIZE = main.RESUMABLE_CHUNK_SIZE + 100000
+# Web photos of the tree made by source()
+ALL_TITLES = ['img0000.jpg', 'img0000.jpg', 'img0001.jpg', 'img0001.jpg']
+
+@pytest.fixture
+def source(tmpdir):
+    source = str(tmpdir.join('media'))
+    benchmark.makeMediaTree(source, 2, 2, 0, 0, 1)
+    return source
+
+def runMain(service, source, tmpdir, *args):
+    # Exit status and output of a run without waits between retries, with tmpdir as its home
+    command = [sys.executable, MAIN_PATH, '--email', benchmark.USER, '--password', 'secret',
+               '--server', service.base, '--source', source, '--manifest', str(tmpdir.join('manifest.sqlite')),
+               '--no-resize', '--retry-max-delay', '0'] + list(args)
+    env = dict(os.environ)
+    env['HOME'] = str(tmpdir)
+    child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    output = child.communicate()[0]
+    return child.returncode, output
+
+def webTitles(service):
+    return sorted(photo['title'] for photo in service.photos.values())
+
+def addCaptioned(source, name, caption):
+    # A JPEG whose EXIF ImageDescription is caption (UTF-8)
+    tiff = 'II*\x00' + struct.pack('<IH', 8, 1) + struct.pack('<HHII', 0x010e, 2, len(caption) + 1, 26)
+    tiff += struct.pack('<I', 0) + caption + '\x00'
+    Image.new('RGB', (64, 48)).save(os.path.join(source, 'album000', name), exif='Exif\x00\x00' + tiff)
+
+def addVideo(source, name, size):
+    path = os.path.join(source, 'album000', name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+def testSyncThenNothingToDo(service, source, tmpdir):
+    status, output = runMain(service, source, tmpdir)
+    assert status == 0, output
+    assert webTitles(service) == ALL_TITLES
+    uploads = service.counters['uploads']
+    status, output = runMain(service, source, tmpdir)
+    assert status == 0, output
+    assert service.counters['uploads'] == uploads
+
+def testFailedAlbumListingIsRetriedAtTheEnd(service, source, tmpdir):
+    # Both attempts to list the existing web album fail; the dead letter pass gets it
+    service.addAlbum('album000')
+    service.script('GET', r'/albumid/\w+$', [500, 500])
+    status, output = runMain(service, source, tmpdir, '--retry-attempts', '2')
+    assert status == 0, output
+    assert 'giving up on album album000' in output
+    assert webTitles(service) == ALL_TITLES
+
+def testFailedMetadataUpdateIsRetriedAtTheEnd(service, source, tmpdir):
+    addCaptioned(source, 'caption.jpg', 'caf\xc3\xa9')
+    assert runMain(service, source, tmpdir)[0] == 0
+    photo = [photo for photo in service.photos.values() if photo['title'] == 'caption.jpg'][0]
+    assert photo['summary'] == 'caf\xc3\xa9'
+    photo['summary'] = 'edited on the web'
+    service.script('PUT', r'/entry/.*/photoid/\w+$', [500, 500])
+    status, output = runMain(service, source, tmpdir, '--forcemetadata', '--metadata-jobs', '1', '--retry-attempts', '2')
+    assert status == 0, output
+    assert 'giving up on caption.jpg' in output
+    assert photo['summary'] == 'caf\xc3\xa9'
+    # Up to date now, non-ASCII caption and all
+    updates = service.counters['metadataUpdates']
+    assert runMain(service, source, tmpdir, '--forcemetadata')[0] == 0
+    assert service.counters['metadataUpdates'] == updates
+
+def testThrottledUploadIsRetried(service, source, tmpdir):
+    service.script('POST', r'/albumid/\w+$', [503, 503])
+    report = str(tmpdir.join('report.json'))
+    status, output = runMain(service, source, tmpdir, '--jobs', '2', '--report', report)
+    assert status == 0, output
+    assert webTitles(service) == ALL_TITLES
+    with open(report) as f:
+        assert json.load(f)['counters']['throttled'] == 2
+
+def testEmptyVideo(service, source, tmpdir):
+    addVideo(source, 'empty.mp4', 0)
+    status, output = runMain(service, source, tmpdir)
+    assert status == 0, output
+    assert [photo['size'] for photo in service.photos.values() if photo['title'] == 'empty.mp4'] == [0]
+
+def testInterruptedUploadResumesInNextRun(service, source, tmpdir):
+    # The first chunk goes through, every later PUT to the session fails
+    addVideo(source, 'clip.mp4', VIDEO_SIZE)
+    service.script('PUT', r'/upload/session/', [None] + [500] * 20)
+    status, output = runMain(service, source, tmpdir, '--retry-attempts', '2')
+    assert 'clip.mp4' not in webTitles(service), output
+    service.scripts = []
+    received = service.counters['bytesReceived']
+    status, output = runMain(service, source, tmpdir)
+    assert status == 0, output
+    assert webTitles(service).count('clip.mp4') == 1
+    # Only the second chunk is sent again
+    assert service.counters['bytesReceived'] - received < VIDEO_SIZE - main.RESUMABLE_CHUNK_SIZE + 65536
+    db = sqlite3.connect(str(tmpdir.join('manifest.sqlite')))
+    assert db.execute("SELECT COUNT(*) FROM journal WHERE state != 'done'").fetchone()[0] == 0
+
+def testLostEntryIsNotUploadedTwice(service, source, tmpdir):
+    addVideo(source, 'clip.mp4', 1000)
+    service.dropEntries = 1
+    status, output = runMain(service, source, tmpdir)
+    assert status == 0, output
+    assert service.counters['droppedEntries'] == 1
+    assert webTitles(service).count('clip.mp4') == 1
+
+def testUnansweredPostsAreNotSentTwice(service, source, tmpdir):
+    # The album and the first photo arrive, but their answers are lost
+    service.dropPosts = 2
+    status, output = runMain(service, source, tmpdir)
+    assert status == 0, output
+    assert service.counters['droppedPosts'] == 2
+    assert len(service.albums) == 2
+    assert webTitles(service) == ALL_TITLES
+
+def testSharedDirectoryNameGoesToTheFirstPath(tmpdir):
+    for parent in ['b', 'a', 'c']:
+        os.makedirs(str(tmpdir.join(parent, '2019')))
+        Image.new('RGB', (8, 8)).save(str(tmpdir.join(parent, '2019', parent + '.jpg')))
+    index = main.MediaIndex()
+    names = [index.add(album) for album in main.discoverMedia(str(tmpdir), False)]
+    assert names == ['2019', None, None]
+    assert index['2019'].path == str(tmpdir.join('a', '2019'))
+
+class Touched(object):
+    def __init__(self):
+        self.paths = set()
+
+    def touched(self, path):
+        self.paths.add(path)
+
+def testWatchSeesFilesOfADirectoryMovedIn(tmpdir):
+    pytest.importorskip('pyinotify')
+    watched = tmpdir.mkdir('watched')
+    os.makedirs(str(tmpdir.join('outside', 'sub')))
+    Image.new('RGB', (8, 8)).save(str(tmpdir.join('outside', 'sub', 'a.jpg')))
+    changes = Touched()
+    notifier = main.startInotifyWatch(str(watched), changes)
+    try:
+        time.sleep(0.2)
+        os.rename(str(tmpdir.join('outside')), str(watched.join('moved')))
+        deadline = time.time() + 5
+        while not changes.paths and time.time() < deadline:
+            time.sleep(0.1)
+        assert changes.paths == set([str(watched.join('moved', 'sub', 'a.jpg'))])
+    finally:
+        notifier.stop()
+
+def testFileMovedToAnotherDirectoryTakesItsPhotoAlong(service, source, tmpdir):
+    assert runMain(service, source, tmpdir)[0] == 0
+    uploads = service.counters['uploads']
+    os.rename(os.path.join(source, 'album000', 'img0001.jpg'), os.path.join(source, 'album001', 'moved.jpg'))
+    os.makedirs(os.path.join(source, 'album002'))
+    os.rename(os.path.join(source, 'album001', 'img0000.jpg'), os.path.join(source, 'album002', 'img0000.jpg'))
+    status, output = runMain(service, source, tmpdir)
+    assert status == 0, output
+    assert service.counters['uploads'] == uploads
+    assert service.counters['moves'] == 2
+    byAlbum = sorted((service.albums[photo['album']]['title'], photo['title']) for photo in service.photos.values())
+    assert byAlbum == [('album000', 'img0000.jpg'), ('album001', 'img0001.jpg'), ('album001', 'moved.jpg'),
+                       ('album002', 'img0000.jpg')]
+    # The manifest knows the files where they are now
+    status, output = runMain(service, source, tmpdir, '--check')
+    assert 'nothing to do' in output
+
+def testLogFollowsSubmissionOrder(service, source, tmpdir):
+    status, output = runMain(service, source, tmpdir, '--jobs', '3')
+    assert status == 0, output
+    lines = output.splitlines()
+    created = lines.index('Creating album album001')
+    assert created > max(n for n, line in enumerate(lines) if 'album000' + os.sep in line)
+    assert created < min(n for n, line in enumerate(lines) if 'album001' + os.sep in line)
+
+def testSequentialUploadResizesAhead(tmpdir, monkeypatch):
+    paths = []
+    for n in range(4):
+        paths.append(str(tmpdir.join('big%d.jpg' % n)))
+        Image.new('RGB', (main.PICASA_MAX_FREE_IMAGE_DIMENSION + 10, 10)).save(paths[-1])
+    pending = []
+    monkeypatch.setattr(main, 'upload', lambda gd_client, localPath, *args: pending.append(sorted(main.pendingResizes)))
+    pool = multiprocessing.Pool(2)
+    monkeypatch.setattr(main, 'resizePool', pool)
+    monkeypatch.setattr(main, 'resizeWorkers', 2)
+    try:
+        main.queueUploads(None, [(path, None, os.path.basename(path), None) for path in paths], False)
+    finally:
+        main.pendingResizes.clear()
+        pool.terminate()
+    # While the first image is uploaded, the next two are already being resized
+    assert pending[0] == paths[:3]
+    assert pending[-1] == paths
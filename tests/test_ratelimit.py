@@ -0,0 +1,32 @@
+# Concurrency limit and kept-alive connections under failures
+
+import pytest
+
+import main
+
+def testConcurrencyRampsUpThenBacksOff():
+    concurrency = main.AdaptiveConcurrency(8)
+    limits = []
+    for i in range(8):
+        concurrency.acquire()
+        concurrency.release(False, True)
+        limits.append(concurrency.limit)
+    assert limits == [2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 8.0]
+    concurrency.acquire()
+    concurrency.release(True, False)
+    assert concurrency.limit == 4.0
+    # After a throttle it grows by about one per round of calls
+    for i in range(4):
+        concurrency.acquire()
+        concurrency.release(False, True)
+    assert 4.5 < concurrency.limit < 5.0
+
+def testPostIsNotSentAgainOnStaleConnection(client, service):
+    # The album feed leaves a kept-alive connection; the POST on it is carried out, but its answer is lost
+    client.GetUserFeed()
+    service.dropPosts = 1
+    with pytest.raises(main.RETRY_EXCEPTIONS):
+        client.http_client.request('POST', service.base + '/data/feed/api/user/default',
+            "<entry xmlns='http://www.w3.org/2005/Atom'><title>once</title></entry>",
+            {'Content-Type': 'application/atom+xml'})
+    assert [album['title'] for album in service.albums.values()] == ['once']
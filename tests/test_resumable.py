@@ -0,0 +1,93 @@
+# ResumableUpload against the fake service
+
+import os
+
+import pytest
+
+import main
+
+def makeUpload(client, service, tmpdir, size, location=None, sessions=None):
+    album = client.InsertAlbum(title='resumable', summary='')
+    path = str(tmpdir.join('clip.mp4'))
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    entry = main.gdata.photos.PhotoEntry()
+    entry.title = main.atom.Title(text='clip.mp4')
+    onSession = sessions.append if sessions is not None else None
+    return main.ResumableUpload(client, album, entry, path, 'video/mp4', location=location, onSession=onSession,
+        findEntry=lambda: main.findWebPhotoEntry(client, album, 'clip.mp4'))
+
+@pytest.fixture(autouse=True)
+def smallChunks(monkeypatch):
+    monkeypatch.setattr(main, 'RESUMABLE_CHUNK_SIZE', 1000)
+
+def uploadedSizes(service):
+    return [photo['size'] for photo in service.photos.values()]
+
+def testUploadInChunks(client, service, tmpdir):
+    entry = makeUpload(client, service, tmpdir, 4500).run()
+    assert entry.title.text == 'clip.mp4'
+    assert uploadedSizes(service) == [4500]
+    assert service.counters['bytesReceived'] < 4500 + 2000
+
+def testEmptyFile(client, service, tmpdir):
+    upload = makeUpload(client, service, tmpdir, 0)
+    upload.run()
+    assert uploadedSizes(service) == [0]
+    assert upload.digest() == main.fileHash(upload.path)
+
+def testEntryAskedForWhenAllBytesAcknowledged(client, service, tmpdir):
+    service.lateEntry = True
+    makeUpload(client, service, tmpdir, 2500).run()
+    assert uploadedSizes(service) == [2500]
+
+def testConnectionLostResumesSameSession(client, service, tmpdir):
+    sessions = []
+    service.dropChunks = 2
+    upload = makeUpload(client, service, tmpdir, 4500, sessions=sessions)
+    upload.run()
+    assert len(sessions) == 1
+    assert service.counters['droppedChunks'] == 2
+    assert uploadedSizes(service) == [4500]
+    # Chunks sent again are not hashed twice
+    assert upload.digest() == main.fileHash(upload.path)
+
+def testInterruptedUploadContinuesAfterRaising(client, service, tmpdir):
+    # More lost connections than RESUMABLE_MAX_RESUMES before the last chunk
+    upload = makeUpload(client, service, tmpdir, 9500)
+    service.dropChunks = 100
+    with pytest.raises(main.GooglePhotosException):
+        upload.run()
+    assert service.photos == {}
+    service.dropChunks = 0
+    upload.run()
+    assert uploadedSizes(service) == [9500]
+
+def testResumeSessionOfEarlierRun(client, service, tmpdir):
+    sessions = []
+    first = makeUpload(client, service, tmpdir, 9500, sessions=sessions)
+    service.dropChunks = 100
+    with pytest.raises(main.GooglePhotosException):
+        first.run()
+    service.dropChunks = 0
+    received = service.counters['bytesReceived']
+    # A new run only knows the session location, written down by onSession
+    second = main.ResumableUpload(client, first.album, first.entry, first.path, 'video/mp4', location=sessions[0])
+    second.run()
+    assert uploadedSizes(service) == [9500]
+    # Only the part the server did not have yet is sent again
+    assert service.counters['bytesReceived'] - received < 9500 - 5000
+    # ... so this run can not tell the hash of the file
+    assert second.digest() is None
+
+def testFinishedSessionIsNotUploadedAgain(client, service, tmpdir):
+    # The upload finished, but its entry never arrived and the session is gone
+    sessions = []
+    upload = makeUpload(client, service, tmpdir, 2500, sessions=sessions)
+    service.dropEntries = 1
+    with pytest.raises(main.GooglePhotosException):
+        upload.run()
+    entry = upload.run()
+    assert main.photoIdOf(entry) in service.photos
+    assert uploadedSizes(service) == [2500]
+    assert len(sessions) == 1
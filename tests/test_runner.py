@@ -0,0 +1,64 @@
+# Bandwidth split and job bookkeeping of runner.py
+
+import json
+import os
+import subprocess
+
+import runner
+
+def testSplitEvenlyAmongBusyJobs():
+    assert runner.splitBandwidth(900, {'a': None, 'b': None, 'c': None}) == {'a': 300, 'b': 300, 'c': 300}
+
+def testUnusedShareGoesToBusyJobs():
+    assert runner.splitBandwidth(1000, {'a': None, 'b': None, 'idle': 50}) == {'a': 475, 'b': 475, 'idle': 50}
+
+def testShareNobodyWantsIsSpread():
+    assert runner.splitBandwidth(1000, {'a': 100, 'b': 100}) == {'a': 500, 'b': 500}
+
+def exitStatus(script):
+    child = subprocess.Popen(['sh', '-c', script])
+    pid, status, usage = os.wait4(child.pid, 0)
+    return runner.exitCode(status)
+
+def testExitCode():
+    assert exitStatus('exit 0') == 0
+    assert exitStatus('exit 1') == 1
+    assert exitStatus('kill -9 $$') == -9
+
+def share(path):
+    with open(path) as f:
+        return json.load(f)['bytesPerSecond']
+
+def reportUsage(path, bytesPerSecond):
+    with open(path + '.usage', 'w') as f:
+        json.dump({'bytesPerSecond': bytesPerSecond}, f)
+
+def testBudgetFollowsUsage(tmpdir):
+    budget = runner.Budget(1000, 4, 2, str(tmpdir))
+    try:
+        busy, cores = budget.start('busy')
+        idle, cores = budget.start('idle')
+        # Nobody reported yet: an even split
+        assert share(busy) == share(idle) == 500
+        reportUsage(busy, 500)
+        reportUsage(idle, 10)
+        with budget.lock:
+            budget.rebalance()
+        assert share(idle) == 125
+        assert share(busy) == 875
+        # The idle job starts using all it gets
+        reportUsage(idle, 125)
+        with budget.lock:
+            budget.rebalance()
+        assert share(busy) == share(idle) == 500
+        budget.finish('idle')
+        assert share(busy) == 1000
+        assert not os.path.exists(idle) and not os.path.exists(idle + '.usage')
+    finally:
+        budget.close()
+
+def testSourcesOfAnAccountHaveTheirOwnManifest():
+    family = runner.manifestPath({'email': 'me@gmail.com', 'source': '/photos/family'})
+    travel = runner.manifestPath({'email': 'me@gmail.com', 'source': '/archive/family'})
+    assert family != travel
+    assert runner.manifestPath({'email': 'me@gmail.com', 'source': '/photos/family/'}) == family